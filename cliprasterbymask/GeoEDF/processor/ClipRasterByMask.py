@@ -2,28 +2,47 @@
 # -*- coding: utf-8 -*-
 
 import os
+import re
 
-from qgis.core import *
-from qgis.analysis import QgsNativeAlgorithms
-import processing
-from processing.core.Processing import Processing 
+from osgeo import gdal, ogr
+from joblib import Parallel, delayed
 
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 
-os.environ['QT_QPA_PLATFORM']='offscreen'
+from .helper import QGISSession
+from .helper import RasterProfile
+from .helper import ZonalSummary
 
 """ Module for clipping a raster to the extents of a given mask layer as a Shapefile.
     The two files may be in different projections; here we reproject to the mask layer's
     projection. The raster can be in any standard raster format
+    With the gdal engine, reprojection and clipping are fused into a single multithreaded 
+    GDAL warp that only reads the part of the raster covering the mask, without loading QGIS.
+    The qgis engine uses a QGIS session that is initialized once per process.
+    In batch mode, every raster in raster_dir is clipped to the mask. In per_feature mode, 
+    a separate clip is produced for every polygon of the mask, named after its name_field 
+    attribute. These modes use the gdal engine and run the clips on a pool of n_jobs workers.
+    With output_profile cog, clips are written as compressed Cloud Optimized GeoTIFFs.
+    In summary_only mode, no raster is written; instead the statistics of the raster inside 
+    the mask (or each of its features) are written to a summary.json or summary.csv file.
 """
 
 class ClipRasterByMask(GeoEDFPlugin):
 
     # in workflow mode, the destination directory will be provided
     # only a directory/folder of rasters is required
-    __optional_params = []
-    __required_params = ['raster_file','mask_shapefile']
+    # engine is either qgis (default) or gdal
+    # either a raster_file or a raster_dir of rasters needs to be provided
+    # per_feature clips to every polygon of the mask separately
+    # output_profile is either default or cog, the latter compressed using compression
+    __optional_params = ['engine','raster_file','raster_dir','per_feature','name_field','n_jobs',
+                         'output_profile','compression',
+                         'summary_only','summary_format','histogram_bins','class_counts']
+    __required_params = ['mask_shapefile']
+
+    # extensions of files in raster_dir that are not rasters themselves
+    __sidecar_extensions = ('.aux.xml','.ovr','.msk','.prj','.xml')
 
     # we use just kwargs since this makes it easier to instantiate the object from the 
     # GeoEDFProcessor class
@@ -37,6 +56,10 @@ class ClipRasterByMask(GeoEDFPlugin):
             if param not in kwargs:
                 raise GeoEDFError('Required parameter %s for ClipRasterByMask not provided' % param)
 
+        # exactly one of raster_file or raster_dir needs to be provided
+        if ('raster_file' in kwargs) == ('raster_dir' in kwargs):
+            raise GeoEDFError('Exactly one of raster_file or raster_dir needs to be provided to ClipRasterByMask')
+
         # set all required parameters
         for key in self.__required_params:
             setattr(self,key,kwargs.get(key))
@@ -46,131 +69,241 @@ class ClipRasterByMask(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
 
+        self.per_feature = str(self.per_feature).lower() in ['true','yes','1']
+        self.summary_only = str(self.summary_only).lower() in ['true','yes','1']
+        self.class_counts = str(self.class_counts).lower() in ['true','yes','1']
+        self.batch = self.raster_dir is not None or self.per_feature or self.summary_only
+
+        # engine used for reprojecting and clipping; batch modes use gdal
+        if self.engine is None:
+            if self.batch:
+                self.engine = 'gdal'
+            else:
+                self.engine = 'qgis'
+        if self.engine not in ['qgis','gdal']:
+            raise GeoEDFError('engine for ClipRasterByMask must be either qgis or gdal')
+        if self.batch and self.engine != 'gdal':
+            raise GeoEDFError('raster_dir, per_feature and summary_only in ClipRasterByMask require the gdal engine')
+
+        # zonal summary options
+        if self.summary_format is None:
+            self.summary_format = 'json'
+        if self.summary_format not in ['json','csv']:
+            raise GeoEDFError('summary_format for ClipRasterByMask must be either json or csv')
+        try:
+            if self.histogram_bins is not None:
+                self.histogram_bins = int(self.histogram_bins)
+                if self.histogram_bins < 1:
+                    raise ValueError
+        except ValueError:
+            raise GeoEDFError('histogram_bins for ClipRasterByMask must be a positive integer')
+
+        # number of clips run in parallel
+        try:
+            if self.n_jobs is None:
+                self.n_jobs = -1
+            self.n_jobs = int(self.n_jobs)
+        except ValueError:
+            raise GeoEDFError('n_jobs for ClipRasterByMask must be an integer')
+
+        # profile of the output rasters
+        (self.output_profile,self.compression) = RasterProfile.validateProfile(self.output_profile,self.compression)
+
         super().__init__()
 
-    # the process method that performs the masking of raster by the mask layer
-    # first reproject raster to mask layer's projection
-    # then clip reprojected raster to the mask layer's extents
-    def process(self):
-        
-        # QGIS initialization
+    # determine mask layer's projection as WKT
+    def mask_srs(self):
         try:
-            qgs = QgsApplication([], False)
-            qgs.initQgis()
-            Processing.initialize()
-            QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+            mask_ds = ogr.Open(self.mask_shapefile)
+            mask_srs = mask_ds.GetLayer().GetSpatialRef().ExportToWkt()
+            mask_ds = None
         except:
-            raise GeoEDFError('Error when initializing QGIS in ClipRasterByMask processor!')
-
-        #determine mask layer's projection
+            raise GeoEDFError('Error determining projection of mask layer: %s in ClipRasterByMask' % os.path.split(self.mask_shapefile)[1])
+        return mask_srs
+
+    # make a name safe for use in a filename and unique among the names used so far
+    def unique_name(self,name,used_names):
+        name = re.sub(r'[^A-Za-z0-9_.-]+','_',str(name)).strip('_')
+        if name == '':
+            name = 'clip'
+        unique = name
+        count = 1
+        while unique in used_names:
+            unique = '%s_%d' % (name,count)
+            count += 1
+        used_names.add(unique)
+        return unique
+
+    # list of (FID, output name) of the features of the mask layer
+    # names are derived from the name_field attribute, or the FID if none is provided
+    def mask_features(self):
         try:
-            input_crs = QgsVectorLayer(self.mask_shapefile, '', 'ogr' ).crs().authid()
+            mask_ds = ogr.Open(self.mask_shapefile)
+            mask_layer = mask_ds.GetLayer()
         except:
-            raise GeoEDFError('Error determining projection of mask layer: %s in ClipRasterByMask' % os.path.split(self.mask_shapefile)[1])
-
-        # now reproject raster
+            raise GeoEDFError('Error reading mask layer: %s in ClipRasterByMask' % os.path.split(self.mask_shapefile)[1])
+        if self.name_field is not None and mask_layer.GetLayerDefn().GetFieldIndex(self.name_field) < 0:
+            raise GeoEDFError('Field %s not found in mask layer in ClipRasterByMask' % self.name_field)
+        features = []
+        used_names = set()
+        for feature in mask_layer:
+            if self.name_field is not None:
+                name = feature.GetField(self.name_field)
+            else:
+                name = feature.GetFID()
+            features.append((feature.GetFID(),self.unique_name(name,used_names)))
+        mask_ds = None
+        return features
+
+    # rasters in raster_dir, in sorted order
+    def list_rasters(self):
+        rasters = []
+        for filename in sorted(os.listdir(self.raster_dir)):
+            filepath = os.path.join(self.raster_dir,filename)
+            if not os.path.isfile(filepath) or filename.lower().endswith(self.__sidecar_extensions):
+                continue
+            if gdal.IdentifyDriver(filepath) is not None:
+                rasters.append(filepath)
+        if len(rasters) == 0:
+            raise GeoEDFError('No rasters found in %s in ClipRasterByMask' % self.raster_dir)
+        return rasters
+
+    # reproject and clip in one pass with gdal.Warp; the cutline is reprojected to the
+    # target CRS by GDAL, and only the source window covering it is read
+    # cutline_where restricts the cutline to some features of the mask layer
+    # COGs are written from a warped VRT, so that the warp happens while the COG is written
+    def warp_clip(self,source,clipped_raster,mask_srs,cutline_where=None,warp_threads='ALL_CPUS'):
+        if self.output_profile == 'cog':
+            warp_path = '/vsimem/clip_%d_%s.vrt' % (id(self),os.path.split(clipped_raster)[1])
+            warp_format = 'VRT'
+        else:
+            warp_path = clipped_raster
+            warp_format = 'GTiff'
         try:
-            # path to temp reprojected file
-            reprojected_raster = '%s/reprojected.tif' % self.target_path
-            processing.run('gdal:warpreproject', {'INPUT': self.raster_file, 'TARGET_CRS': input_crs, 'OUTPUT': reprojected_raster})
+            warp_options = gdal.WarpOptions(format=warp_format,
+                                            dstSRS=mask_srs,
+                                            cutlineDSName=self.mask_shapefile,
+                                            cutlineWhere=cutline_where,
+                                            cropToCutline=True,
+                                            multithread=True,
+                                            warpOptions=['NUM_THREADS=%s' % warp_threads],
+                                            creationOptions=['TILED=YES','BIGTIFF=IF_SAFER'])
+            warped = gdal.Warp(warp_path,source,options=warp_options)
+            warped = None
         except:
-            raise GeoEDFError('Error reprojecting raster file to mask layer projection in ClipRasterByMask!')
-            
-        # finally clip the reprojected raster
+            raise GeoEDFError('Error clipping raster %s to mask extents in ClipRasterByMask!' % os.path.split(clipped_raster)[1])
+        if self.output_profile == 'cog':
+            try:
+                RasterProfile.writeCOG(warp_path,clipped_raster,self.compression)
+            finally:
+                gdal.Unlink(warp_path)
+
+    def clip_gdal(self,clipped_raster):
+
+        gdal.UseExceptions()
+
+        self.warp_clip(self.raster_file,clipped_raster,self.mask_srs())
+
+    # batch and per-feature clipping; the mask layer is read once, and in per-feature
+    # mode every raster is reprojected once into a warped VRT that all its clips read from
+    # outputs are named <raster>.tif, <feature>.tif or <raster>_<feature>.tif
+    def clip_batch(self):
+
+        gdal.UseExceptions()
+
+        mask_srs = self.mask_srs()
+        if self.raster_dir is not None:
+            rasters = self.list_rasters()
+        else:
+            rasters = [self.raster_file]
+        if self.per_feature:
+            features = self.mask_features()
+        else:
+            features = [None]
+
+        # each worker warps with a single thread
+        if self.n_jobs == 1:
+            warp_threads = 'ALL_CPUS'
+        else:
+            warp_threads = 1
+
+        vrt_paths = []
+        jobs = []
+        used_names = set()
+        try:
+            for raster in rasters:
+                raster_name = self.unique_name(os.path.splitext(os.path.split(raster)[1])[0],used_names)
+                source = raster
+                if self.per_feature:
+                    source = '/vsimem/clip_%d_%s.vrt' % (id(self),raster_name)
+                    vrt_paths.append(source)
+                    try:
+                        vrt = gdal.Warp(source,raster,format='VRT',dstSRS=mask_srs)
+                        vrt = None
+                    except:
+                        raise GeoEDFError('Error reprojecting raster %s to mask layer projection in ClipRasterByMask!' % os.path.split(raster)[1])
+                for feature in features:
+                    if feature is None:
+                        jobs.append((source,'%s/%s.tif' % (self.target_path,raster_name),None))
+                    else:
+                        (fid, feature_name) = feature
+                        if self.raster_dir is not None:
+                            clipped_raster = '%s/%s_%s.tif' % (self.target_path,raster_name,feature_name)
+                        else:
+                            clipped_raster = '%s/%s.tif' % (self.target_path,feature_name)
+                        jobs.append((source,clipped_raster,'FID = %d' % fid))
+
+            Parallel(n_jobs=self.n_jobs,prefer='threads')(delayed(self.warp_clip)(source,clipped_raster,mask_srs,cutline_where,warp_threads) for (source,clipped_raster,cutline_where) in jobs)
+        finally:
+            for vrt_path in vrt_paths:
+                gdal.Unlink(vrt_path)
+
+    # statistics of the rasters inside the mask, computed block by block on the source grid
+    # without writing any clipped raster; rasters are summarized in parallel
+    def summarize(self):
+
+        if self.raster_dir is not None:
+            rasters = self.list_rasters()
+        else:
+            rasters = [self.raster_file]
+        if self.per_feature:
+            zone_names = [feature_name for (fid, feature_name) in self.mask_features()]
+        else:
+            zone_names = ['mask']
+
+        raster_records = Parallel(n_jobs=self.n_jobs,prefer='threads')(delayed(ZonalSummary.summarizeRaster)(raster,self.mask_shapefile,zone_names,self.per_feature,self.histogram_bins,self.class_counts) for raster in rasters)
+
+        records = [record for records in raster_records for record in records]
+        summary_path = '%s/summary.%s' % (self.target_path,self.summary_format)
         try:
-            # path to final output file
-            clipped_raster = '%s/clipped.tif' % self.target_path
-            processing.run('gdal:cliprasterbymasklayer',{'INPUT': reprojected_raster, 'MASK': self.mask_shapefile, 'OUTPUT': clipped_raster})
+            ZonalSummary.writeSummary(records,summary_path,self.summary_format)
         except:
-            raise GeoEDFError('Error clipping raster to mask extents in ClipRasterByMask!')
-
-        # delete the intermediate reprojected raster file since we don't want it to be picked up
-        # in subsequent workflow steps
-        os.remove(reprojected_raster)
-        
-        
-
-        
-        
-
-
-
-                    
-
-
-                    
-
-            
-            
-
-        
-
-
-
-
-
-
-#!/usr/bin/env python
-# -*- coding: utf-8 -*-
-
-import os
-
-from qgis.core import *
-from qgis.analysis import QgsNativeAlgorithms
-import processing
-from processing.core.Processing import Processing 
-
-from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
-from geoedfframework.utils.GeoEDFError import GeoEDFError
-
-os.environ['QT_QPA_PLATFORM']='offscreen'
-
-""" Module for clipping a raster to the extents of a given mask layer as a Shapefile.
-    The two files may be in different projections; here we reproject to the mask layer's
-    projection. The raster can be in any standard raster format
-"""
-
-class ClipRasterByMask(GeoEDFPlugin):
-
-    # in workflow mode, the destination directory will be provided
-    # only a directory/folder of rasters is required
-    __optional_params = []
-    __required_params = ['raster_file','mask_shapefile']
-
-    # we use just kwargs since this makes it easier to instantiate the object from the 
-    # GeoEDFProcessor class
-    def __init__(self, **kwargs):
-
-        #list to hold all parameter names
-        self.provided_params = self.__required_params + self.__optional_params
-
-        # check that all required params have been provided
-        for param in self.__required_params:
-            if param not in kwargs:
-                raise GeoEDFError('Required parameter %s for ClipRasterByMask not provided' % param)
-
-        # set all required parameters
-        for key in self.__required_params:
-            setattr(self,key,kwargs.get(key))
-
-        # set optional parameters
-        for key in self.__optional_params:
-            # if key not provided in optional arguments, defaults value to None
-            setattr(self,key,kwargs.get(key,None))
-
-        super().__init__()
+            raise GeoEDFError('Error writing zonal summary in ClipRasterByMask')
 
     # the process method that performs the masking of raster by the mask layer
     # first reproject raster to mask layer's projection
     # then clip reprojected raster to the mask layer's extents
     def process(self):
+
+        # statistics only
+        if self.summary_only:
+            self.summarize()
+        # batch or per-feature clipping
+        elif self.batch:
+            self.clip_batch()
+        # single pass with GDAL
+        elif self.engine == 'gdal':
+            self.clip_gdal('%s/clipped.tif' % self.target_path)
+        else:
+            self.clip_qgis('%s/clipped.tif' % self.target_path)
+
+    # reproject and clip with the QGIS GDAL algorithms
+    def clip_qgis(self,clipped_raster):
         
-        # QGIS initialization
+        # QGIS initialization, once per process
         try:
-            qgs = QgsApplication([], False)
-            qgs.initQgis()
-            Processing.initialize()
-            QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+            QGISSession.getSession()
+            from qgis.core import QgsVectorLayer
         except:
             raise GeoEDFError('Error when initializing QGIS in ClipRasterByMask processor!')
         
@@ -184,18 +317,19 @@ class ClipRasterByMask(GeoEDFPlugin):
         try:
             # path to temp reprojected file
             reprojected_raster = '%s/reprojected.tif' % self.target_path
-            processing.run('gdal:warpreproject', {'INPUT': self.raster_file, 'TARGET_CRS': input_crs, 'OUTPUT': reprojected_raster})
+            QGISSession.runAlgorithm('gdal:warpreproject', {'INPUT': self.raster_file, 'TARGET_CRS': input_crs, 'OUTPUT': reprojected_raster})
         except:
             raise GeoEDFError('Error reprojecting raster file to mask layer projection in ClipRasterByMask!')
 
         # finally clip the reprojected raster
         try:
-            # path to final output file
-            clipped_raster = '%s/clipped.tif' % self.target_path
-            processing.run('gdal:cliprasterbymasklayer',{'INPUT': reprojected_raster, 'MASK': self.mask_shapefile, 'OUTPUT': clipped_raster})
+            QGISSession.runAlgorithm('gdal:cliprasterbymasklayer',{'INPUT': reprojected_raster, 'MASK': self.mask_shapefile, 'OUTPUT': clipped_raster})
         except:
             raise GeoEDFError('Error clipping raster to mask extents in ClipRasterByMask!')
 
         # delete the intermediate reprojected raster file since we don't want it to be picked up
         # in subsequent workflow steps
         os.remove(reprojected_raster)
+
+        if self.output_profile == 'cog':
+            RasterProfile.convertToCOG(clipped_raster,self.compression)
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import threading
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module providing a process-wide QGIS session. QGIS is only imported and
+    initialized (along with the processing framework and native algorithms) the first
+    time a processing algorithm is run, so code paths that do not need QGIS never pay
+    its startup cost, and batch runs in the same process pay it only once.
+"""
+
+# the initialized QgsApplication, shared by all processors in this process
+_qgs = None
+_lock = threading.Lock()
+
+def getSession():
+    global _qgs
+    with _lock:
+        if _qgs is None:
+            os.environ['QT_QPA_PLATFORM']='offscreen'
+            try:
+                from qgis.core import QgsApplication
+                from qgis.analysis import QgsNativeAlgorithms
+                from processing.core.Processing import Processing
+
+                qgs = QgsApplication([], False)
+                qgs.initQgis()
+                Processing.initialize()
+                QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
+            except:
+                raise GeoEDFError('Error when initializing QGIS')
+            _qgs = qgs
+    return _qgs
+
+# run a QGIS processing algorithm in the shared session
+def runAlgorithm(name,params):
+    getSession()
+    import processing
+    return processing.run(name,params)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+
+from osgeo import gdal
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for writing output rasters in a given profile. The default profile
+    leaves rasters as written by the processor. The cog profile writes Cloud Optimized
+    GeoTIFFs: tiled, compressed with a predictor, and with internal overviews that are
+    computed using all available cores.
+"""
+
+PROFILES = ['default','cog']
+
+COMPRESSIONS = ['DEFLATE','ZSTD','LZW','NONE']
+
+def validateProfile(output_profile,compression):
+    if output_profile is None:
+        output_profile = 'default'
+    if output_profile not in PROFILES:
+        raise GeoEDFError('output_profile must be one of %s' % ', '.join(PROFILES))
+    if compression is None:
+        compression = 'DEFLATE'
+    compression = str(compression).upper()
+    if compression not in COMPRESSIONS:
+        raise GeoEDFError('compression must be one of %s' % ', '.join(COMPRESSIONS))
+    return (output_profile,compression)
+
+def cogCreationOptions(compression):
+    options = ['COMPRESS=%s' % compression,
+               'OVERVIEWS=AUTO',
+               'NUM_THREADS=ALL_CPUS',
+               'BIGTIFF=IF_SAFER']
+    if compression != 'NONE':
+        options.append('PREDICTOR=YES')
+    return options
+
+# write a COG from a source raster (path or dataset), e.g. a VRT that is only
+# materialized while the COG is written
+def writeCOG(source,output_path,compression):
+    gdal.UseExceptions()
+    try:
+        gdal.Translate(output_path,source,format='COG',creationOptions=cogCreationOptions(compression))
+    except:
+        raise GeoEDFError('Error writing Cloud Optimized GeoTIFF %s' % os.path.split(output_path)[1])
+
+# rewrite a GeoTIFF already written to disk as a COG in place
+def convertToCOG(raster_path,compression):
+    cog_path = '%s.cog.tif' % os.path.splitext(raster_path)[0]
+    try:
+        writeCOG(raster_path,cog_path,compression)
+        os.replace(cog_path,raster_path)
+    finally:
+        if os.path.exists(cog_path):
+            os.remove(cog_path)
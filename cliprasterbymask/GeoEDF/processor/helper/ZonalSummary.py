@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import csv
+import json
+import math
+import os
+
+import numpy as np
+from osgeo import gdal, ogr, osr
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for computing zonal statistics of a raster inside the polygons of a
+    mask layer, without writing out the clipped raster. The mask is reprojected to the
+    raster's CRS and rasterized onto the raster grid one block of rows at a time, only
+    within the window covering the mask; the statistics of every zone (the whole mask,
+    or each of its features) are accumulated block by block with NumPy. Since a pixel can only
+    hold one zone, overlapping features are rasterized in separate groups, so that pixels in
+    the overlap count towards every feature that covers them. Histograms span
+    the exact range of the pixels inside the mask, found in a first pass over the blocks.
+"""
+
+# number of pixels read per block
+BLOCK_PIXELS = 1 << 22
+
+# statistics written for every zone and band
+STATISTICS = ['count','sum','mean','min','max','std']
+
+# in-memory layer of the mask polygons in the raster's CRS, with a zone attribute
+# that is 1 for all features, or the position of the feature (from 1) if per_feature
+# with per_feature, features are also assigned to groups (from 0) of features that do not
+# overlap each other, in a group attribute; returns the number of groups along with the layer
+def zoneLayer(mask_shapefile,raster_srs,per_feature):
+    mask_ds = ogr.Open(mask_shapefile)
+    mask_layer = mask_ds.GetLayer()
+    mask_srs = mask_layer.GetSpatialRef()
+
+    # keep x/y axis order for the transformation with GDAL 3
+    if hasattr(osr,'OAMS_TRADITIONAL_GIS_ORDER'):
+        mask_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+        raster_srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(mask_srs,raster_srs)
+
+    zone_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    zone_layer = zone_ds.CreateLayer('zones',srs=raster_srs,geom_type=ogr.wkbMultiPolygon)
+    zone_layer.CreateField(ogr.FieldDefn('zone',ogr.OFTInteger))
+    zone_layer.CreateField(ogr.FieldDefn('grp',ogr.OFTInteger))
+    # geometries of the features in each group
+    groups = [[]]
+    for (index, feature) in enumerate(mask_layer):
+        geom = feature.GetGeometryRef()
+        if geom is None:
+            continue
+        geom = geom.Clone()
+        geom.Transform(transform)
+        zone_feature = ogr.Feature(zone_layer.GetLayerDefn())
+        if per_feature:
+            zone_feature.SetField('zone',index+1)
+            zone_feature.SetField('grp',overlapGroup(groups,geom))
+        else:
+            zone_feature.SetField('zone',1)
+            zone_feature.SetField('grp',0)
+        zone_feature.SetGeometry(geom)
+        zone_layer.CreateFeature(zone_feature)
+    mask_ds = None
+    # the datasource needs to be kept alive along with the layer
+    return (zone_ds,zone_layer,len(groups))
+
+# first group in which a geometry overlaps (with a non-zero area) none of the others,
+# adding it to that group, or to a new group if it overlaps a geometry in every group
+def overlapGroup(groups,geom):
+    (minx, maxx, miny, maxy) = geom.GetEnvelope()
+    for (grp, members) in enumerate(groups):
+        overlaps = False
+        for (member, (mminx, mmaxx, mminy, mmaxy)) in members:
+            if mminx >= maxx or mmaxx <= minx or mminy >= maxy or mmaxy <= miny:
+                continue
+            intersection = geom.Intersection(member)
+            if intersection is not None and intersection.GetArea() > 0:
+                overlaps = True
+                break
+        if not overlaps:
+            members.append((geom,(minx,maxx,miny,maxy)))
+            return grp
+    groups.append([(geom,(minx,maxx,miny,maxy))])
+    return len(groups) - 1
+
+# pixel window (xoff, yoff, xsize, ysize) of the raster covering an extent
+def extentWindow(geotransform,xsize,ysize,extent):
+    inv_geotransform = gdal.InvGeoTransform(geotransform)
+    (minx, maxx, miny, maxy) = extent
+    pixels = [gdal.ApplyGeoTransform(inv_geotransform,x,y) for x in (minx,maxx) for y in (miny,maxy)]
+    x0 = max(0,int(math.floor(min([px for (px, py) in pixels]))))
+    x1 = min(xsize,int(math.ceil(max([px for (px, py) in pixels]))))
+    y0 = max(0,int(math.floor(min([py for (px, py) in pixels]))))
+    y1 = min(ysize,int(math.ceil(max([py for (px, py) in pixels]))))
+    return (x0,y0,max(0,x1-x0),max(0,y1-y0))
+
+# statistics of every band of a raster within every zone
+# returns one record per zone and band, in zone and band order
+def summarizeRaster(raster_path,mask_shapefile,zone_names,per_feature=False,histogram_bins=None,class_counts=False,block_pixels=BLOCK_PIXELS):
+
+    gdal.UseExceptions()
+
+    try:
+        raster_ds = gdal.Open(raster_path)
+        raster_srs = osr.SpatialReference(wkt=raster_ds.GetProjection())
+        geotransform = raster_ds.GetGeoTransform()
+        (zone_ds, zone_layer, ngroups) = zoneLayer(mask_shapefile,raster_srs,per_feature)
+    except:
+        raise GeoEDFError('Error reading raster %s or mask layer for zonal summary' % raster_path)
+
+    nzones = len(zone_names) + 1
+    nbands = raster_ds.RasterCount
+    bands = [raster_ds.GetRasterBand(i+1) for i in range(nbands)]
+    nodata = [band.GetNoDataValue() for band in bands]
+
+    # accumulators per band, indexed by zone (zone 0 is outside the mask)
+    count = np.zeros((nbands,nzones),dtype='int64')
+    total = np.zeros((nbands,nzones),dtype='float64')
+    total_sq = np.zeros((nbands,nzones),dtype='float64')
+    minimum = np.full((nbands,nzones),np.inf)
+    maximum = np.full((nbands,nzones),-np.inf)
+    classes = [[dict() for zone in range(nzones)] for band in range(nbands)]
+
+    (x0, y0, xsize, ysize) = extentWindow(geotransform,raster_ds.RasterXSize,raster_ds.RasterYSize,zone_layer.GetExtent())
+    rows = max(1,block_pixels // max(1,xsize))
+
+    # zones and valid values of every band inside the mask, block by block; with overlapping
+    # features, a block yields the zones and values of every group of features in turn
+    def maskedBlocks():
+        mem_driver = gdal.GetDriverByName('MEM')
+        for yoff in range(y0,y0+ysize,rows):
+            block_rows = min(rows,y0+ysize-yoff)
+
+            # rasterize the zones of every group onto this block of the raster grid
+            group_zones = []
+            for grp in range(ngroups):
+                zone_block = mem_driver.Create('',xsize,block_rows,1,gdal.GDT_Int32)
+                zone_block.SetGeoTransform((geotransform[0] + x0*geotransform[1] + yoff*geotransform[2], geotransform[1], geotransform[2],
+                                            geotransform[3] + x0*geotransform[4] + yoff*geotransform[5], geotransform[4], geotransform[5]))
+                zone_block.SetProjection(raster_ds.GetProjection())
+                zone_layer.SetAttributeFilter('grp = %d' % grp)
+                gdal.RasterizeLayer(zone_block,[1],zone_layer,options=['ATTRIBUTE=zone'])
+                zone_layer.SetAttributeFilter(None)
+                zones = zone_block.ReadAsArray().ravel()
+                zone_block = None
+                if (zones > 0).any():
+                    group_zones.append(zones)
+
+            if len(group_zones) == 0:
+                continue
+
+            for (b, band) in enumerate(bands):
+                vals = band.ReadAsArray(x0,yoff,xsize,block_rows).ravel().astype('float64')
+                valid = ~np.isnan(vals)
+                if nodata[b] is not None:
+                    valid &= vals != nodata[b]
+                for zones in group_zones:
+                    zone_valid = valid & (zones > 0)
+                    if zone_valid.any():
+                        yield (b,zones[zone_valid],vals[zone_valid])
+
+    hist_ranges = []
+    hists = None
+    if histogram_bins is not None:
+        # exact range of the masked pixels of every band, so that every pixel falls in a bin
+        lows = np.full(nbands,np.inf)
+        highs = np.full(nbands,-np.inf)
+        for (b, block_zones, block_vals) in maskedBlocks():
+            lows[b] = min(lows[b],block_vals.min())
+            highs[b] = max(highs[b],block_vals.max())
+        hist_ranges = [(lows[b],highs[b]) if lows[b] <= highs[b] else (0.0,0.0) for b in range(nbands)]
+        hists = np.zeros((nbands,nzones,histogram_bins),dtype='int64')
+
+    for (b, block_zones, block_vals) in maskedBlocks():
+        count[b] += np.bincount(block_zones,minlength=nzones)
+        total[b] += np.bincount(block_zones,weights=block_vals,minlength=nzones)
+        total_sq[b] += np.bincount(block_zones,weights=block_vals*block_vals,minlength=nzones)
+        np.minimum.at(minimum[b],block_zones,block_vals)
+        np.maximum.at(maximum[b],block_zones,block_vals)
+
+        if hists is not None:
+            (lo, hi) = hist_ranges[b]
+            width = (hi - lo) if hi > lo else 1.0
+            bins = np.clip(((block_vals - lo) / width * histogram_bins).astype('int64'),0,histogram_bins-1)
+            hists[b] += np.bincount(block_zones*histogram_bins + bins,minlength=nzones*histogram_bins).reshape((nzones,histogram_bins))
+
+        if class_counts:
+            (pairs, pair_counts) = np.unique(np.stack([block_zones.astype('float64'),block_vals]),axis=1,return_counts=True)
+            for ((zone, value), pair_count) in zip(pairs.T,pair_counts):
+                zone_classes = classes[b][int(zone)]
+                zone_classes[value] = zone_classes.get(value,0) + int(pair_count)
+
+    raster_ds = None
+    zone_ds = None
+
+    records = []
+    for (zone, zone_name) in enumerate(zone_names,start=1):
+        for b in range(nbands):
+            record = {'raster': os.path.split(raster_path)[1], 'zone': zone_name, 'band': b+1, 'count': int(count[b][zone])}
+            if count[b][zone] > 0:
+                mean = total[b][zone] / count[b][zone]
+                record.update({'sum': total[b][zone],
+                               'mean': mean,
+                               'min': minimum[b][zone],
+                               'max': maximum[b][zone],
+                               'std': math.sqrt(max(0.0,total_sq[b][zone] / count[b][zone] - mean*mean))})
+            else:
+                record.update(dict([(stat,None) for stat in STATISTICS[1:]]))
+            if hists is not None:
+                (lo, hi) = hist_ranges[b]
+                record['histogram'] = {'edges': list(np.linspace(lo,hi,histogram_bins+1)), 'counts': [int(c) for c in hists[b][zone]]}
+            if class_counts:
+                record['class_counts'] = dict([('%g' % value, classes[b][zone][value]) for value in sorted(classes[b][zone].keys())])
+            records.append(record)
+    return records
+
+# write the summary records as JSON, or as CSV with one column per histogram bin and class
+def writeSummary(records,summary_path,summary_format):
+    if summary_format == 'json':
+        with open(summary_path,'w') as summary_file:
+            json.dump(records,summary_file,indent=2)
+        return
+
+    columns = ['raster','zone','band'] + STATISTICS
+    hist_columns = []
+    class_columns = []
+    for record in records:
+        if 'histogram' in record and len(hist_columns) == 0:
+            hist_columns = ['hist_%d' % i for i in range(len(record['histogram']['counts']))]
+        for value in record.get('class_counts',{}).keys():
+            if 'class_%s' % value not in class_columns:
+                class_columns.append('class_%s' % value)
+    with open(summary_path,'w',newline='') as summary_file:
+        writer = csv.DictWriter(summary_file,fieldnames=columns+hist_columns+class_columns)
+        writer.writeheader()
+        for record in records:
+            row = dict([(column,record.get(column)) for column in columns])
+            if 'histogram' in record:
+                row.update(zip(hist_columns,record['histogram']['counts']))
+            for (value, value_count) in record.get('class_counts',{}).items():
+                row['class_%s' % value] = value_count
+            writer.writerow(row)
@@ -3,8 +3,9 @@
 
 import os
 import sys
-import csv
 import numpy as np
+import pandas as pd
+from joblib import Parallel, delayed
 
 from harpy import *
 
@@ -15,15 +16,21 @@ from geoedfframework.utils.GeoEDFError import GeoEDFError
     files of a specific format; i.e. those that contain region-wise aggregate values 
     of some FAOSTAT dataset variable. The CSV needs to contain two columns; first the 
     region's code name and second the float value for that region.
+    More generally, any number of set columns (e.g. REG and COMM) can be listed in dims; 
+    every other column is then converted into a header array over those sets.
+    A directory of such CSV files can also be converted in one go, either into one HAR file 
+    per CSV file or into a single combined HAR file with one header per variable.
 """
 
 class CSV2HAR(GeoEDFPlugin):
 
     # in workflow mode, the destination directory will be provided
-    # input csv file is required
+    # either an input csv file or a directory of csv files is required
     # har file with the same basename as the csv file is created
-    __optional_params = []
-    __required_params = ['csvfile']
+    # if combined, a single har file named basename (or after the directory) is created for a directory
+    # dims lists the set columns of the csv files (defaults to REG), all other columns are values
+    __optional_params = ['csvfile','csvdir','combined','basename','n_jobs','dims']
+    __required_params = []
 
     # we use just kwargs since this makes it easier to instantiate the object from the 
     # GeoEDFPlugin class
@@ -37,6 +44,10 @@ class CSV2HAR(GeoEDFPlugin):
             if param not in kwargs:
                 raise GeoEDFError('Required parameter %s for CSV2HAR not provided' % param)
 
+        # exactly one of csvfile or csvdir needs to be provided
+        if ('csvfile' in kwargs) == ('csvdir' in kwargs):
+            raise GeoEDFError('Exactly one of csvfile or csvdir needs to be provided to CSV2HAR')
+
         # set all required parameters
         for key in self.__required_params:
             setattr(self,key,kwargs.get(key))
@@ -46,64 +57,182 @@ class CSV2HAR(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
 
+        # a directory is converted into one har file per csv file unless combined is set
+        self.combined = str(self.combined).lower() in ['true','yes','1']
+
+        # number of csv files parsed in parallel
+        try:
+            if self.n_jobs is None:
+                self.n_jobs = -1
+            self.n_jobs = int(self.n_jobs)
+        except ValueError:
+            raise GeoEDFError('n_jobs for CSV2HAR must be an integer')
+
+        # set columns of the csv files
+        if self.dims is None:
+            self.dims = ['REG']
+        elif not isinstance(self.dims,list):
+            self.dims = [dim.strip() for dim in str(self.dims).split(',') if dim.strip() != '']
+        if len(self.dims) == 0:
+            raise GeoEDFError('At least one set column needs to be provided in dims to CSV2HAR')
+
         super().__init__()
 
+    # parse a CSV file into its sets and the arrays of values of all other fields
+    # all fields are read as strings (so that region codes like NA are preserved) and the
+    # values are pivoted onto the sets in one go; set elements are kept in order of appearance
+    # returns a list of (set name, elements) and a list of (field name, array) tuples
+    def parse_csv(self,csvfile):
+        csv_df = pd.read_csv(csvfile,dtype=str,keep_default_na=False)
+        for dim in self.dims:
+            if dim not in csv_df.columns:
+                raise GeoEDFError("Error in CSV2HAR when processing %s. Set field %s not found" % (csvfile,dim))
+        data_keys = [key for key in csv_df.columns if key not in self.dims]
+        if len(data_keys) == 0:
+            raise GeoEDFError("Error in CSV2HAR when processing %s. At least one value field is required" % csvfile)
+
+        sets = []
+        codes = []
+        for dim in self.dims:
+            (dim_codes, dim_elements) = pd.factorize(csv_df[dim])
+            sets.append((dim,list(dim_elements)))
+            codes.append(dim_codes)
+
+        # combinations of set elements missing from the file are set to zero
+        shape = tuple([len(elements) for (ignore, elements) in sets])
+        data_arr = np.zeros(shape + (len(data_keys),),dtype='float32')
+        data_arr[tuple(codes)] = csv_df[data_keys].values.astype('float32')
+
+        return (sets, [(data_key,data_arr[...,i]) for (i, data_key) in enumerate(data_keys)])
+
+    # build the set header for a list of set elements
+    def set_header(self,set_name,elements):
+        # in this header, element names are always padded to 12 characters long
+        set_arr = np.array([elem.ljust(12) for elem in elements],dtype='<U12')
+        set_setNames = [set_name]
+        set_setElements = [[elem.ljust(12) for elem in elements]]
+        set_coeff_name = ''.ljust(12)
+        set_long_name = ('Set %s inferred from CSV file' % set_name).ljust(70)
+        return HeaderArrayObj.HeaderArrayFromData(set_arr,set_coeff_name,set_long_name,set_setNames,dict(zip(set_setNames,set_setElements)))
+
+    # build a data header over the given sets
+    def data_header(self,vals,sets,coeff_name,long_name):
+        csv_arr = np.array(vals,dtype='float32')
+        csv_setNames = [set_name for (set_name, ignore) in sets]
+        csv_setElements = [elements for (ignore, elements) in sets]
+        csv_coeff_name = coeff_name[:12].ljust(12)
+        csv_long_name = long_name[:70].ljust(70)
+        return HeaderArrayObj.HeaderArrayFromData(csv_arr,csv_coeff_name,csv_long_name,csv_setNames,dict(zip(csv_setNames,csv_setElements)))
+
+    # HAR header names are at most 4 characters long; make them unique by replacing
+    # trailing characters with a counter
+    def unique_header_name(self,name,used_names):
+        header_name = name[:4].upper()
+        count = 1
+        while header_name in used_names:
+            suffix = str(count)
+            header_name = name[:4-len(suffix)].upper() + suffix
+            count += 1
+        used_names.add(header_name)
+        return header_name
+
+    # write the headers parsed from one CSV file to a HAR file
+    # a CSV file with a single set and value field results in the SET1 and CSV headers;
+    # otherwise there is a SETn header per set and a header per value field
+    # set headers are looked up in (and added to) set_headers, keyed by set name and elements
+    def write_har(self,harFilename,sets,values,set_headers):
+        harFile = HarFileObj(harFilename)
+        for (set_name, elements) in sets:
+            if (set_name,tuple(elements)) not in set_headers:
+                set_headers[(set_name,tuple(elements))] = self.set_header(set_name,elements)
+        if len(sets) == 1 and len(values) == 1:
+            (set_name, elements) = sets[0]
+            harFile["SET1"] = set_headers[(set_name,tuple(elements))]
+            harFile["CSV"] = self.data_header(values[0][1],sets,'CSVData','Array extracted from CSV')
+        else:
+            used_names = set()
+            for (i, (set_name, elements)) in enumerate(sets):
+                harFile[self.unique_header_name('SET%d' % (i+1),used_names)] = set_headers[(set_name,tuple(elements))]
+            for (data_key, vals) in values:
+                harFile[self.unique_header_name(data_key,used_names)] = self.data_header(vals,sets,data_key,'%s extracted from CSV' % data_key)
+        harFile.writeToDisk()
+
+    # union of the elements of every set across parsed CSV files, in order of first appearance
+    def union_sets(self,parsed):
+        union = [(dim,[]) for dim in self.dims]
+        seen = [set() for dim in self.dims]
+        for (sets, ignore) in parsed:
+            for (i, (ignore, elements)) in enumerate(sets):
+                for elem in elements:
+                    if elem not in seen[i]:
+                        seen[i].add(elem)
+                        union[i][1].append(elem)
+        return union
+
+    # place an array of values over a file's sets onto the union sets; elements missing
+    # from the file are set to zero
+    def align_values(self,vals,sets,union):
+        positions = [dict([(elem,pos) for (pos, elem) in enumerate(elements)]) for (ignore, elements) in union]
+        index = [[positions[i][elem] for elem in elements] for (i, (ignore, elements)) in enumerate(sets)]
+        aligned = np.zeros(tuple([len(elements) for (ignore, elements) in union]),dtype='float32')
+        aligned[np.ix_(*index)] = vals
+        return aligned
+
+    # convert a directory of CSV files; files are parsed in parallel and each set header
+    # is built only once for every distinct list of set elements
+    def process_dir(self):
+
+        csvfiles = sorted(['%s/%s' % (self.csvdir,filename) for filename in os.listdir(self.csvdir) if filename.endswith('.csv')])
+        if len(csvfiles) == 0:
+            raise GeoEDFError('No CSV files found in %s in CSV2HAR' % self.csvdir)
+
+        try:
+            parsed = Parallel(n_jobs=self.n_jobs)(delayed(self.parse_csv)(csvfile) for csvfile in csvfiles)
+        except GeoEDFError:
+            raise
+        except:
+            raise GeoEDFError('Error parsing CSV files in %s in CSV2HAR' % self.csvdir)
+
+        set_headers = dict()
+
+        if self.combined:
+            # one har file with a single header per set, holding the union of its elements across
+            # all files, and a header per variable with its values aligned onto these sets
+            if self.basename is not None:
+                basename = self.basename
+            else:
+                basename = os.path.split(os.path.normpath(self.csvdir))[1]
+            harFile = HarFileObj('%s/%s.har' % (self.target_path,basename))
+            used_names = set()
+            union = self.union_sets(parsed)
+            for (i, (set_name, elements)) in enumerate(union):
+                harFile[self.unique_header_name('SET%d' % (i+1),used_names)] = self.set_header(set_name,elements)
+            for (csvfile, (sets, values)) in zip(csvfiles,parsed):
+                csvFilename = os.path.split(csvfile)[1]
+                for (data_key, vals) in values:
+                    header_name = self.unique_header_name(data_key,used_names)
+                    harFile[header_name] = self.data_header(self.align_values(vals,sets,union),union,data_key,'%s extracted from %s' % (data_key,csvFilename))
+            harFile.writeToDisk()
+        else:
+            # one har file per csv file
+            for (csvfile, (sets, values)) in zip(csvfiles,parsed):
+                basename = os.path.splitext(os.path.split(csvfile)[1])[0]
+                self.write_har('%s/%s.har' % (self.target_path,basename),sets,values,set_headers)
+
     # the process method that performs the conversion from csv to har format
     # the HARPY library is used to create the necessary header array objects from the data
     def process(self):
-        
-        # first read the CSV file to fetch the regions and their corresponding values
-        regions = []
-        vals = []
 
-        # name of the data field
-        data_key = None
+        # directory mode
+        if self.csvdir is not None:
+            self.process_dir()
+            return
         
-        with open(self.csvfile,'r') as csvFileObj:
-            reader = csv.DictReader(csvFileObj)
-            for row in reader:
-                # pre-process step only required once
-                # determine the name of the data field
-                if data_key is None:
-                    if len(list(row.keys())) != 2:
-                        raise GeoEDFError("Error in CSV2HAR when processing %s. Exactly two fields are required" % self.csvfile)
-                    else:
-                        # REG is one, what is the other?
-                        for key in row.keys():
-                            if key != 'REG':
-                                data_key = key
-                                break
-                regions.append(row['REG'])
-                vals.append(row[data_key])
-
-        # now build the HAR file header
-        # first create the HAR file object
+        # first read the CSV file to fetch the sets and the values of every other field
+        (sets, values) = self.parse_csv(self.csvfile)
+
+        # now build the HAR file headers and write out the HAR file
         (ignore, csvFilename) = os.path.split(self.csvfile)
         basename = os.path.splitext(csvFilename)[0]
         harFilename = '%s/%s.har' % (self.target_path,basename)
-        harFile = HarFileObj(harFilename)
-
-        # create the two header array objects and set them to the file
-        
-        # first the region header
-        # in this header, region names are always padded to 12 characters long
-        reg_arr = np.array([reg.ljust(12) for reg in regions],dtype='<U12')
-        reg_setNames = ['REG']
-        reg_setElements = [[reg.ljust(12) for reg in regions]]
-        reg_coeff_name = ''.ljust(12)
-        reg_long_name = 'Set REG inferred from CSV file'.ljust(70)
-        reg_header = HeaderArrayObj.HeaderArrayFromData(reg_arr,reg_coeff_name,reg_long_name,reg_setNames,dict(zip(reg_setNames,reg_setElements)))
-        # add header to HAR file
-        harFile["SET1"] = reg_header
-
-        # then the csv data header
-        csv_arr = np.array(vals,dtype='float32')
-        csv_setNames = ['REG']
-        csv_setElements = [regions]
-        csv_coeff_name = 'CSVData'.ljust(12)
-        csv_long_name = 'Array extracted from CSV'.ljust(70)
-        csv_header = HeaderArrayObj.HeaderArrayFromData(csv_arr,csv_coeff_name,csv_long_name,csv_setNames,dict(zip(csv_setNames,csv_setElements)))
-        harFile["CSV"] = csv_header
-
-        # write out the HAR file
-        harFile.writeToDisk()
+        self.write_har(harFilename,sets,values,dict())
@@ -8,4 +8,5 @@ setup(name='csv2har',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
+      install_requires=['pandas','numpy','joblib'],
       zip_safe=False)
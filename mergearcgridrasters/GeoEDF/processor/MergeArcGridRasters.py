@@ -4,28 +4,43 @@
 import os
 import zipfile
 
-from qgis.core import *
-from qgis.analysis import QgsNativeAlgorithms
-import processing
-from processing.core.Processing import Processing 
+from osgeo import gdal
+from joblib import Parallel, delayed
 
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 
-os.environ['QT_QPA_PLATFORM']='offscreen'
+from .helper import QGISSession
+from .helper import RasterProfile
+from .helper import TiledComposite
 
 """ Module for merging a directory of rasters which are in the ArcGrid format
     The QGIS gdal:merge processor is used to merge the given rasters
     Given a directory input, the subdirectories with names beginning in "grd"
     are assumed to hold an ArcGrid raster file and used as the input list of 
     raster to merge
+    With the gdal engine, the rasters are mosaicked through a GDAL VRT without loading QGIS;
+    the qgis engine uses a QGIS session that is initialized once per process.
+    With output_profile cog, the merged raster is written as a compressed Cloud Optimized GeoTIFF.
+    With output_format vrt, only a VRT mosaic (merged_raster.vrt) referencing the input rasters 
+    is written; otherwise the gdal engine materializes the mosaic with a multithreaded warp.
+    ArcGrid coverages inside zip files are read in place through GDAL's /vsizip/ paths; 
+    with extract_zips, the zip files are instead extracted (in parallel) as before.
+    The tiled engine composites the rasters block by block on a pool of n_jobs workers, 
+    resolving overlaps by overlap_rule (first, last, min, max or mean, ignoring nodata).
 """
 
 class MergeArcGridRasters(GeoEDFPlugin):
 
     # in workflow mode, the destination directory will be provided
     # only a directory/folder of rasters is required
-    __optional_params = []
+    # engine is either qgis (default), gdal or tiled
+    # overlap_rule and block_size control the tiled engine
+    # output_profile is either default or cog, the latter compressed using compression
+    # output_format is either tif (default) or vrt; cache_size_mb bounds GDAL's block cache
+    # extract_zips extracts zipped coverages instead of reading them in place, using n_jobs workers
+    __optional_params = ['engine','output_profile','compression','output_format','cache_size_mb',
+                         'extract_zips','n_jobs','overlap_rule','block_size']
     __required_params = ['input_folder']
 
     # we use just kwargs since this makes it easier to instantiate the object from the 
@@ -49,25 +64,90 @@ class MergeArcGridRasters(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
 
+        # output format of the mosaic
+        if self.output_format is None:
+            self.output_format = 'tif'
+        if self.output_format not in ['tif','vrt']:
+            raise GeoEDFError('output_format for MergeArcGridRasters must be either tif or vrt')
+
+        # engine used for merging; VRT mosaics are built with gdal, overlap rules need tiled
+        if self.engine is None:
+            if self.output_format == 'vrt':
+                self.engine = 'gdal'
+            elif self.overlap_rule is not None:
+                self.engine = 'tiled'
+            else:
+                self.engine = 'qgis'
+        if self.engine not in ['qgis','gdal','tiled']:
+            raise GeoEDFError('engine for MergeArcGridRasters must be one of qgis, gdal or tiled')
+        if self.output_format == 'vrt' and self.engine != 'gdal':
+            raise GeoEDFError('output_format vrt for MergeArcGridRasters requires the gdal engine')
+
+        # profile of the output raster
+        (self.output_profile,self.compression) = RasterProfile.validateProfile(self.output_profile,self.compression)
+        if self.output_format == 'vrt' and self.output_profile != 'default':
+            raise GeoEDFError('output_profile cannot be used with output_format vrt in MergeArcGridRasters')
+
+        # tiled compositing options
+        if self.overlap_rule is None:
+            self.overlap_rule = 'last'
+        if self.overlap_rule not in TiledComposite.OVERLAP_RULES:
+            raise GeoEDFError('overlap_rule for MergeArcGridRasters must be one of %s' % ', '.join(TiledComposite.OVERLAP_RULES))
+        if self.overlap_rule != 'last' and self.engine != 'tiled':
+            raise GeoEDFError('overlap_rule for MergeArcGridRasters requires the tiled engine')
+        try:
+            if self.block_size is None:
+                self.block_size = 1024
+            self.block_size = int(self.block_size)
+            if self.block_size < 1:
+                raise ValueError
+        except ValueError:
+            raise GeoEDFError('block_size for MergeArcGridRasters must be a positive integer')
+
+        # block cache used by GDAL when materializing the mosaic
+        try:
+            if self.cache_size_mb is not None:
+                self.cache_size_mb = int(self.cache_size_mb)
+        except ValueError:
+            raise GeoEDFError('cache_size_mb for MergeArcGridRasters must be an integer')
+
+        # zip files are read in place unless extraction is requested
+        self.extract_zips = str(self.extract_zips).lower() in ['true','yes','1']
+        try:
+            if self.n_jobs is None:
+                self.n_jobs = -1
+            self.n_jobs = int(self.n_jobs)
+        except ValueError:
+            raise GeoEDFError('n_jobs for MergeArcGridRasters must be an integer')
+
         super().__init__()
 
     # the process method that performs the raster merging operation and saves resulting 
     # merged raster GeoTiff file to the target directory. 
     def process(self):
-        
-        # QGIS initialization
-        try:
-            qgs = QgsApplication([], False)
-            qgs.initQgis()
-            Processing.initialize()
-            QgsApplication.processingRegistry().addProvider(QgsNativeAlgorithms())
-        except:
-            raise GeoEDFError('Error when initializing QGIS in MergeArcGridRasters processor!')
+
+        input_raster_list = self.find_rasters()
+
+        # now merge them
+        output_raster = "%s/merged_raster.tif" % self.target_path
+        if self.output_format == 'vrt':
+            self.build_vrt(input_raster_list,"%s/merged_raster.vrt" % self.target_path)
+        elif self.engine == 'gdal':
+            self.merge_gdal(input_raster_list,output_raster)
+        elif self.engine == 'tiled':
+            self.merge_tiled(input_raster_list,output_raster)
+        else:
+            self.merge_qgis(input_raster_list,output_raster)
+
+    # identify the rasters to be merged, extracting zip files if necessary
+    # rasters are listed in name order, so that the first and last overlap rules do not
+    # depend on the order in which the filesystem lists directories
+    def find_rasters(self):
 
         # identify rasters to be merged
         input_raster_list = []
         zipfiles_list = []
-        for file_or_dir in os.listdir(self.input_folder):
+        for file_or_dir in sorted(os.listdir(self.input_folder)):
             file_or_dir_path = os.path.join(self.input_folder,file_or_dir)
             if os.path.isdir(file_or_dir_path) & file_or_dir.startswith("grd"):
                 input_raster_list.append(file_or_dir_path)
@@ -77,18 +157,23 @@ class MergeArcGridRasters(GeoEDFPlugin):
         # check if any rasters found
         if len(input_raster_list) == 0:
             # it's possible that the ArcGrid files are in zip format
-            # unzip and try again
-            if len(zipfiles_list) > 0:
-                for arcgrid_zipfile in zipfiles_list:
-                    with zipfile.ZipFile(arcgrid_zipfile,"r") as zip_ref:
-                        zip_ref.extractall(self.input_folder)
+            # read them in place or unzip and try again
+            if len(zipfiles_list) > 0 and not self.extract_zips:
+                for arcgrid_zipfile in sorted(zipfiles_list):
+                    input_raster_list.extend(self.zipped_coverages(arcgrid_zipfile))
+                #if still no input files, error
+                if len(input_raster_list) == 0:
+                    raise GeoEDFError('No rasters found to merge in MergeArcGridRasters')
+            elif len(zipfiles_list) > 0:
+                Parallel(n_jobs=self.n_jobs,prefer='threads')(delayed(self.extract_zipfile)(arcgrid_zipfile) for arcgrid_zipfile in zipfiles_list)
+                for arcgrid_zipfile in sorted(zipfiles_list):
                     # check to see if a new directory has been created 
                     # look for a "grd" folder in there
                     zipfile_dirname = os.path.splitext(os.path.split(arcgrid_zipfile)[1])[0]
                     zipfile_folder = '%s/%s' % (self.input_folder,zipfile_dirname)
                     if os.path.isdir(zipfile_folder):
                         # check for a grd folder in here
-                        for file_or_dir in os.listdir(zipfile_folder):
+                        for file_or_dir in sorted(os.listdir(zipfile_folder)):
                             file_or_dir_path = os.path.join(zipfile_folder,file_or_dir)
                             if os.path.isdir(file_or_dir_path) & file_or_dir.startswith("grd"):
                                 input_raster_list.append(file_or_dir_path)
@@ -98,9 +183,104 @@ class MergeArcGridRasters(GeoEDFPlugin):
             else: #no zipfiles either
                 raise GeoEDFError('No rasters found to merge in MergeArcGridRasters')
 
-        # now merge them
+        return input_raster_list
+
+    # ArcGrid coverages ("grd" folders holding a hdr.adf file) inside a zip file,
+    # as /vsizip/ paths that GDAL reads without extracting the archive
+    def zipped_coverages(self,arcgrid_zipfile):
+        try:
+            with zipfile.ZipFile(arcgrid_zipfile,"r") as zip_ref:
+                members = zip_ref.namelist()
+        except zipfile.BadZipFile:
+            raise GeoEDFError('Error reading zip file %s in MergeArcGridRasters' % os.path.split(arcgrid_zipfile)[1])
+        coverages = []
+        for member in sorted(members):
+            (coverage_dir, filename) = os.path.split(member)
+            if filename.lower() == 'hdr.adf' and os.path.split(coverage_dir)[1].startswith("grd"):
+                coverages.append('/vsizip/%s/%s' % (os.path.abspath(arcgrid_zipfile),coverage_dir))
+        return coverages
+
+    # extract a zip file into the input folder
+    def extract_zipfile(self,arcgrid_zipfile):
+        try:
+            with zipfile.ZipFile(arcgrid_zipfile,"r") as zip_ref:
+                zip_ref.extractall(self.input_folder)
+        except (zipfile.BadZipFile,OSError):
+            raise GeoEDFError('Error extracting zip file %s in MergeArcGridRasters' % os.path.split(arcgrid_zipfile)[1])
+
+    # merge with the QGIS gdal:merge algorithm
+    def merge_qgis(self,input_raster_list,output_raster):
+
+        # QGIS initialization, once per process
         try:
-            output_raster = "%s/merged_raster.tif" % self.target_path
-            processing.run("gdal:merge",{'INPUT':input_raster_list,'OUTPUT':output_raster})
+            QGISSession.getSession()
+        except:
+            raise GeoEDFError('Error when initializing QGIS in MergeArcGridRasters processor!')
+
+        try:
+            QGISSession.runAlgorithm("gdal:merge",{'INPUT':input_raster_list,'OUTPUT':output_raster})
         except:
             raise GeoEDFError('Error when merging input rasters in MergeArcGridRasters')
+
+        if self.output_profile == 'cog':
+            RasterProfile.convertToCOG(output_raster,self.compression)
+
+    # composite the rasters block by block into a tiled GeoTIFF
+    def merge_tiled(self,input_raster_list,output_raster):
+
+        if self.cache_size_mb is not None:
+            gdal.SetCacheMax(self.cache_size_mb * 1024 * 1024)
+
+        try:
+            TiledComposite.compositeRasters(input_raster_list,output_raster,self.overlap_rule,self.block_size,self.n_jobs)
+        except GeoEDFError:
+            raise
+        except:
+            raise GeoEDFError('Error when merging input rasters in MergeArcGridRasters')
+
+        if self.output_profile == 'cog':
+            RasterProfile.convertToCOG(output_raster,self.compression)
+
+    # build a VRT mosaic of the rasters
+    # (later rasters take precedence where they overlap, as with gdal:merge)
+    def build_vrt(self,input_raster_list,vrt_path):
+
+        gdal.UseExceptions()
+
+        try:
+            vrt = gdal.BuildVRT(vrt_path,input_raster_list)
+            vrt = None
+        except:
+            raise GeoEDFError('Error when merging input rasters in MergeArcGridRasters')
+
+    # merge with the GDAL API; the rasters are mosaicked in an in-memory VRT
+    # which is then materialized block by block with a multithreaded warp
+    def merge_gdal(self,input_raster_list,output_raster):
+
+        gdal.UseExceptions()
+
+        if self.cache_size_mb is not None:
+            gdal.SetCacheMax(self.cache_size_mb * 1024 * 1024)
+
+        vrt_path = '/vsimem/merged_raster_%d.vrt' % id(self)
+        try:
+            self.build_vrt(input_raster_list,vrt_path)
+
+            # a COG is written straight from the mosaic VRT
+            if self.output_profile == 'cog':
+                RasterProfile.writeCOG(vrt_path,output_raster,self.compression)
+            else:
+                try:
+                    warp_kwargs = {'format': 'GTiff',
+                                   'multithread': True,
+                                   'warpOptions': ['NUM_THREADS=ALL_CPUS'],
+                                   'creationOptions': ['TILED=YES','BIGTIFF=IF_SAFER']}
+                    # warp memory is passed in bytes, since gdalwarp reads values of 10000 or more as bytes;
+                    # GDAL's default is used unless a cache size is provided
+                    if self.cache_size_mb is not None:
+                        warp_kwargs['warpMemoryLimit'] = self.cache_size_mb * 1024 * 1024
+                    gdal.Warp(output_raster,vrt_path,options=gdal.WarpOptions(**warp_kwargs))
+                except:
+                    raise GeoEDFError('Error when merging input rasters in MergeArcGridRasters')
+        finally:
+            gdal.Unlink(vrt_path)
@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from osgeo import gdal
+from joblib import Parallel, delayed, cpu_count
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for compositing rasters onto a common output grid block by block.
+    The output grid covers the union of the sources at the resolution of the first
+    source. For every output block, only the intersecting windows of the sources are
+    read, and overlapping pixels are combined by a rule (first, last, min, max or mean),
+    ignoring nodata. Blocks are composited on a pool of worker threads and written to a
+    tiled GeoTIFF by the calling thread, so memory use is bounded by the block size.
+    The mean of integer rasters is written as Float64, so that it is not truncated.
+"""
+
+OVERLAP_RULES = ['first','last','min','max','mean']
+
+# number of source rasters each worker thread keeps open
+MAX_OPEN_SOURCES = 16
+
+# source rasters opened by each worker thread, since GDAL datasets cannot be shared across threads
+# every thread keeps at most max_open datasets, closing the least recently used one; all of them
+# are closed when compositing is done
+class SourceCache(object):
+
+    def __init__(self, max_open=MAX_OPEN_SOURCES):
+        self.max_open = max_open
+        self.local = threading.local()
+        self.caches = []
+        self.lock = threading.Lock()
+
+    def open(self, path):
+        if not hasattr(self.local,'datasets'):
+            self.local.datasets = OrderedDict()
+            with self.lock:
+                self.caches.append(self.local.datasets)
+        datasets = self.local.datasets
+        if path in datasets:
+            datasets.move_to_end(path)
+        else:
+            datasets[path] = gdal.Open(path)
+            # dropping the last reference closes the dataset
+            if len(datasets) > self.max_open:
+                datasets.popitem(last=False)
+        return datasets[path]
+
+    def close(self):
+        with self.lock:
+            for datasets in self.caches:
+                datasets.clear()
+            self.caches = []
+
+# geotransform, size, band count, data type and nodata of every source
+def sourceInfo(paths):
+    sources = []
+    for path in paths:
+        ds = gdal.Open(path)
+        band = ds.GetRasterBand(1)
+        sources.append({'path': path,
+                        'geotransform': ds.GetGeoTransform(),
+                        'xsize': ds.RasterXSize,
+                        'ysize': ds.RasterYSize,
+                        'bands': ds.RasterCount,
+                        'datatype': band.DataType,
+                        'nodata': band.GetNoDataValue(),
+                        'projection': ds.GetProjection()})
+        ds = None
+    return sources
+
+# output grid (minx, maxy, xres, yres, xsize, ysize) covering all sources
+def outputGrid(sources):
+    xres = sources[0]['geotransform'][1]
+    yres = -sources[0]['geotransform'][5]
+    minx = min([src['geotransform'][0] for src in sources])
+    maxy = max([src['geotransform'][3] for src in sources])
+    maxx = max([src['geotransform'][0] + src['xsize']*src['geotransform'][1] for src in sources])
+    miny = min([src['geotransform'][3] + src['ysize']*src['geotransform'][5] for src in sources])
+    xsize = int(math.ceil((maxx - minx) / xres - 1e-6))
+    ysize = int(math.ceil((maxy - miny) / yres - 1e-6))
+    return (minx,maxy,xres,yres,xsize,ysize)
+
+# read the part of a source covering an output block, resampled (nearest) to the output grid
+# returns the output pixel window (x0, y0, x1, y1) within the block and the data, or None
+def readSourceWindow(src,grid,block,cache):
+    (minx, maxy, xres, yres, ignore, ignore) = grid
+    (bx, by, bw, bh) = block
+    gt = src['geotransform']
+
+    # extent of the source in output pixels
+    c0 = int(round((gt[0] - minx) / xres))
+    c1 = int(round((gt[0] + src['xsize']*gt[1] - minx) / xres))
+    r0 = int(round((maxy - gt[3]) / yres))
+    r1 = int(round((maxy - (gt[3] + src['ysize']*gt[5])) / yres))
+
+    x0 = max(bx,c0)
+    x1 = min(bx+bw,c1)
+    y0 = max(by,r0)
+    y1 = min(by+bh,r1)
+    if x0 >= x1 or y0 >= y1:
+        return None
+
+    # corresponding source pixel window
+    sx0 = int(round((minx + x0*xres - gt[0]) / gt[1]))
+    sx1 = int(round((minx + x1*xres - gt[0]) / gt[1]))
+    sy0 = int(round((gt[3] - (maxy - y0*yres)) / -gt[5]))
+    sy1 = int(round((gt[3] - (maxy - y1*yres)) / -gt[5]))
+    sx0 = min(max(sx0,0),src['xsize']-1)
+    sy0 = min(max(sy0,0),src['ysize']-1)
+    sx1 = min(max(sx1,sx0+1),src['xsize'])
+    sy1 = min(max(sy1,sy0+1),src['ysize'])
+
+    ds = cache.open(src['path'])
+    data = ds.ReadAsArray(sx0,sy0,sx1-sx0,sy1-sy0,buf_xsize=x1-x0,buf_ysize=y1-y0)
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    return ((x0-bx,y0-by,x1-bx,y1-by),data.astype('float64'))
+
+# composite one output block from all sources by the overlap rule
+# returns a (bands, rows, cols) array, with nodata where no source has data
+def compositeBlock(sources,grid,block,nbands,rule,nodata,cache):
+    (bx, by, bw, bh) = block
+    out = np.zeros((nbands,bh,bw),dtype='float64')
+    count = np.zeros((nbands,bh,bw),dtype='int64')
+    for src in sources:
+        window = readSourceWindow(src,grid,block,cache)
+        if window is None:
+            continue
+        ((x0, y0, x1, y1), data) = window
+        data = data[:nbands]
+        valid = ~np.isnan(data)
+        if src['nodata'] is not None:
+            valid &= data != src['nodata']
+        out_win = out[:,y0:y1,x0:x1]
+        count_win = count[:,y0:y1,x0:x1]
+        empty = count_win == 0
+        if rule == 'first':
+            take = valid & empty
+        elif rule == 'last':
+            take = valid
+        elif rule == 'min':
+            take = valid & (empty | (data < out_win))
+        elif rule == 'max':
+            take = valid & (empty | (data > out_win))
+        else:
+            take = None
+            out_win[valid] += data[valid]
+        if take is not None:
+            out_win[take] = data[take]
+        count_win[valid] += 1
+    if rule == 'mean':
+        np.divide(out,count,out=out,where=count > 0)
+    if nodata is not None:
+        out[count == 0] = nodata
+    return out
+
+# blocks (x, y, width, height) covering the output grid, in row order
+def gridBlocks(xsize,ysize,block_size):
+    return [(x,y,min(block_size,xsize-x),min(block_size,ysize-y)) for y in range(0,ysize,block_size) for x in range(0,xsize,block_size)]
+
+# composite the input rasters into a tiled GeoTIFF
+def compositeRasters(input_rasters,output_raster,rule='last',block_size=1024,n_jobs=-1):
+
+    gdal.UseExceptions()
+
+    try:
+        sources = sourceInfo(input_rasters)
+    except:
+        raise GeoEDFError('Error reading input rasters for compositing')
+
+    grid = outputGrid(sources)
+    (minx, maxy, xres, yres, xsize, ysize) = grid
+    nbands = min([src['bands'] for src in sources])
+    nodata = sources[0]['nodata']
+    datatype = sources[0]['datatype']
+    if rule == 'mean' and datatype not in [gdal.GDT_Float32,gdal.GDT_Float64]:
+        datatype = gdal.GDT_Float64
+
+    try:
+        out_ds = gdal.GetDriverByName('GTiff').Create(output_raster,xsize,ysize,nbands,datatype,
+                                                     options=['TILED=YES','BLOCKXSIZE=256','BLOCKYSIZE=256','BIGTIFF=IF_SAFER'])
+        out_ds.SetGeoTransform((minx,xres,0.0,maxy,0.0,-yres))
+        out_ds.SetProjection(sources[0]['projection'])
+        out_bands = [out_ds.GetRasterBand(b+1) for b in range(nbands)]
+        if nodata is not None:
+            for out_band in out_bands:
+                out_band.SetNoDataValue(nodata)
+    except:
+        raise GeoEDFError('Error creating composited raster %s' % output_raster)
+
+    blocks = gridBlocks(xsize,ysize,block_size)
+
+    # blocks are composited in batches on the pool and written by this thread,
+    # so that only a batch of blocks is held in memory at a time
+    cache = SourceCache()
+    try:
+        with Parallel(n_jobs=n_jobs,prefer='threads') as parallel:
+            if n_jobs > 0:
+                batch_size = 4 * n_jobs
+            else:
+                batch_size = 4 * cpu_count()
+            for i in range(0,len(blocks),batch_size):
+                batch = blocks[i:i+batch_size]
+                results = parallel(delayed(compositeBlock)(sources,grid,block,nbands,rule,nodata,cache) for block in batch)
+                for ((bx, by, bw, bh), data) in zip(batch,results):
+                    for b in range(nbands):
+                        out_bands[b].WriteArray(data[b],bx,by)
+    finally:
+        cache.close()
+
+    out_ds.FlushCache()
+    out_ds = None
@@ -8,4 +8,5 @@ setup(name='mergearcgridrasters',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
+      install_requires=['joblib','numpy'],
       zip_safe=False)
@@ -6,14 +6,36 @@ from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
 import pandas as pd
 import os
+import glob
+import shutil
+import tempfile
+from joblib import Parallel, delayed, effective_n_jobs
 
 """ Module for implementing the processor for merging a folder of CSV files. This plugin will merge CSV 
-    files in a given folder into a single CSV file.
+    files in a given folder into a single CSV file. Files can either be merged (outer join on their 
+    common columns) or concatenated; concatenation aligns the columns of all files and streams them 
+    to the output in chunks. If join keys are provided, the files are joined out-of-core by hash 
+    partitioning them on the keys into a scratch directory and joining the partitions in parallel.
+    Gzip or Zstandard compressed CSV files are read transparently and the folder can be searched 
+    recursively. A schema inferred from a sample of the files is applied when reading every file.
 """
 
 class MergeCSVFiles(GeoEDFPlugin):
 
-    __optional_params = ['basename']
+    # mode is one of merge (default) or concat
+    # join_keys turns merge mode into an out-of-core keyed join
+    __optional_params = ['basename','mode','chunksize','join_keys','partitions','scratch_dir','n_jobs',
+                         'recursive','engine','sample_rows']
+
+    # extensions of the (optionally compressed) CSV files that are processed
+    __csv_extensions = ('.csv','.csv.gz','.csv.zst')
+
+    # number of files sampled when inferring the schema
+    __sample_files = 10
+
+    # minimum number of hash partitions per concurrently joined partition; this keeps at most
+    # 1/16th of the input in memory during a keyed join
+    __partitions_per_job = 16
     __required_params = ['filepath']
 
     # we use just kwargs since we need to be able to process the list of attributes
@@ -37,10 +59,305 @@ class MergeCSVFiles(GeoEDFPlugin):
         for key in self.__optional_params:
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
+
+        # files are merged via outer joins unless concatenation is requested
+        if self.mode is None:
+            self.mode = 'merge'
+        if self.mode not in ['merge','concat']:
+            raise GeoEDFError('mode for MergeCSVFiles must be one of merge or concat')
+
+        # number of rows read at a time when concatenating
+        try:
+            if self.chunksize is None:
+                self.chunksize = 100000
+            self.chunksize = int(self.chunksize)
+        except ValueError:
+            raise GeoEDFError('chunksize for MergeCSVFiles must be an integer')
+
+        # join keys can be provided as a list or a comma separated string
+        if self.join_keys is not None:
+            if not isinstance(self.join_keys,list):
+                self.join_keys = [key.strip() for key in str(self.join_keys).split(',') if key.strip() != '']
+            if len(self.join_keys) == 0:
+                raise GeoEDFError('At least one join key needs to be provided to MergeCSVFiles')
+            if self.mode != 'merge':
+                raise GeoEDFError('join_keys for MergeCSVFiles can only be used in merge mode')
+
+        # number of hash partitions and parallel jobs for keyed joins
+        # by default there are enough partitions for every job to join its own small share of the input
+        try:
+            if self.n_jobs is None:
+                self.n_jobs = -1
+            self.n_jobs = int(self.n_jobs)
+            if self.partitions is None:
+                self.partitions = self.__partitions_per_job * effective_n_jobs(self.n_jobs)
+            self.partitions = int(self.partitions)
+            if self.partitions < 1:
+                raise ValueError
+        except ValueError:
+            raise GeoEDFError('partitions and n_jobs for MergeCSVFiles must be positive integers')
+
+        # only the top level of filepath is searched unless recursive is set
+        self.recursive = str(self.recursive).lower() in ['true','yes','1']
+
+        # the pyarrow parser and Zstandard decompression in read_csv need pandas 1.4 or later
+        self.pandas_1_4 = tuple([int(part) for part in pd.__version__.split('.')[:2]]) >= (1,4)
+
+        # parser used for whole-file reads; chunked reads always use the C parser
+        if self.engine is None:
+            self.engine = 'c'
+        if self.engine not in ['pyarrow','c']:
+            raise GeoEDFError('engine for MergeCSVFiles must be one of pyarrow or c')
+        if self.engine == 'pyarrow' and not self.pandas_1_4:
+            raise GeoEDFError('engine pyarrow for MergeCSVFiles requires pandas 1.4 or later')
+
+        # rows per file sampled to infer the schema
+        try:
+            if self.sample_rows is None:
+                self.sample_rows = 10000
+            self.sample_rows = int(self.sample_rows)
+        except ValueError:
+            raise GeoEDFError('sample_rows for MergeCSVFiles must be an integer')
             
         # class super class init
         super().__init__()
 
+    # list the CSV files to be processed, sorted by path
+    def list_csv_files(self):
+        if self.recursive:
+            candidates = glob.glob(os.path.join(self.filepath,'**','*'),recursive=True)
+        else:
+            candidates = [os.path.join(self.filepath,filename) for filename in os.listdir(self.filepath)]
+        csv_files = sorted([path for path in candidates if path.endswith(self.__csv_extensions) and os.path.isfile(path)])
+        if not self.pandas_1_4:
+            for csv_file in csv_files:
+                if csv_file.endswith('.zst'):
+                    raise GeoEDFError('Reading Zstandard compressed %s in MergeCSVFiles requires pandas 1.4 or later' % os.path.split(csv_file)[1])
+        return csv_files
+
+    # infer a single schema from a sample of rows of the first few files so that every file is
+    # read with the same column types; columns that are empty in the sample are left to per-file inference
+    def infer_dtypes(self,csv_files):
+        column_kinds = dict()
+        for csv_file in csv_files[:self.__sample_files]:
+            try:
+                sample_df = pd.read_csv(csv_file,nrows=self.sample_rows)
+            except pd.errors.EmptyDataError:
+                continue
+            for column in sample_df.columns:
+                if sample_df[column].isna().all():
+                    continue
+                column_kinds.setdefault(column,set()).add(sample_df[column].dtype.kind)
+
+        dtypes = dict()
+        for column, kinds in column_kinds.items():
+            if kinds == set(['b']):
+                dtypes[column] = 'boolean'
+            elif kinds <= set(['i','u']):
+                # nullable integers, since other files may have missing values
+                dtypes[column] = 'Int64'
+            elif kinds <= set(['i','u','f']):
+                dtypes[column] = 'float64'
+            else:
+                dtypes[column] = 'object'
+        return dtypes
+
+    # widen a schema for the columns of a CSV file that cannot be read with it, e.g. a column that
+    # was sampled as integers but has decimals in a later file; integer columns are widened to floats
+    # and other columns to strings until the column can be read
+    def widen_dtypes(self,csv_file,dtypes):
+        widened = dict(dtypes)
+        for column in pd.read_csv(csv_file,nrows=0).columns:
+            while column in widened and widened[column] not in ['object',str]:
+                try:
+                    for chunk in pd.read_csv(csv_file,usecols=[column],dtype={column: widened[column]},chunksize=self.chunksize):
+                        pass
+                    break
+                except (ValueError,TypeError):
+                    if widened[column] == 'Int64':
+                        widened[column] = 'float64'
+                    else:
+                        widened[column] = 'object'
+        return widened
+
+    # narrowest schema that all the given (possibly widened) schemas can be cast to
+    def widest_dtypes(self,schemas):
+        widest = dict()
+        for dtypes in schemas:
+            for column, dtype in dtypes.items():
+                if column not in widest or widest[column] == dtype:
+                    widest[column] = dtype
+                elif set([widest[column],dtype]) == set(['Int64','float64']):
+                    widest[column] = 'float64'
+                else:
+                    widest[column] = 'object'
+        return widest
+
+    # read a whole CSV file with the inferred schema, widened if the file does not fit it
+    # returns the dataframe and the schema it was read with, or None for empty files
+    def read_csv_file(self,csv_file):
+        try:
+            pd.read_csv(csv_file,nrows=0)
+        except pd.errors.EmptyDataError:
+            return (None,None)
+        try:
+            return (pd.read_csv(csv_file,engine=self.engine,dtype=self.dtypes),self.dtypes)
+        except (ValueError,TypeError):
+            dtypes = self.widen_dtypes(csv_file,self.dtypes)
+            return (pd.read_csv(csv_file,engine=self.engine,dtype=dtypes),dtypes)
+
+    # concatenate the rows of all CSV files into the output file
+    # a first pass over just the headers determines the union of columns (in order of appearance),
+    # a second pass streams each file in chunks, aligned to these columns, to the output file
+    # only one chunk is held in memory at a time
+    # if a file does not fit the schema, the schema is widened and the output is rewritten, so that
+    # every column is written with the same type throughout
+    def concat_files(self,csv_files,output_path,dtypes=None):
+
+        columns = []
+        for csv_file in csv_files:
+            try:
+                for column in pd.read_csv(csv_file,nrows=0).columns:
+                    if column not in columns:
+                        columns.append(column)
+            except pd.errors.EmptyDataError:
+                pass
+
+        while True:
+            try:
+                self.write_concat(csv_files,columns,output_path,dtypes)
+                return
+            except (ValueError,TypeError) as err:
+                if dtypes is None or not hasattr(err,'csv_file'):
+                    raise
+                widened = self.widen_dtypes(err.csv_file,dtypes)
+                if widened == dtypes:
+                    raise
+                dtypes = widened
+
+    # stream the files, aligned to the given columns, to the output file
+    # errors reading a file are tagged with the file
+    def write_concat(self,csv_files,columns,output_path,dtypes):
+        with open(output_path,'w') as output_file:
+            write_header = True
+            for csv_file in csv_files:
+                try:
+                    for chunk in pd.read_csv(csv_file,chunksize=self.chunksize,dtype=dtypes):
+                        chunk.reindex(columns=columns).to_csv(output_file,header=write_header,index=False)
+                        write_header = False
+                except pd.errors.EmptyDataError:
+                    pass
+                except (ValueError,TypeError) as err:
+                    err.csv_file = csv_file
+                    raise
+            # all files were empty or had no rows, still write out the header
+            if write_header and len(columns) > 0:
+                pd.DataFrame(columns=columns).to_csv(output_file,index=False)
+
+    # path of the scratch file holding partition part_num of the file_num'th input file
+    def partition_path(self,scratch_dir,part_num,file_num):
+        return '%s/part%d_file%d.csv' % (scratch_dir,part_num,file_num)
+
+    # split a CSV file into hash partitions on the join keys, reading it in chunks
+    # every partition file is created with a header, even if it receives no rows
+    # returns the schema the file was read with, widened if the file does not fit the inferred one
+    def partition_file(self,file_num,csv_file,scratch_dir):
+
+        # keys are read as strings so that they hash identically across files
+        key_dtypes = dict(self.dtypes)
+        key_dtypes.update([(key,str) for key in self.join_keys])
+        columns = list(pd.read_csv(csv_file,nrows=0).columns)
+        for key in self.join_keys:
+            if key not in columns:
+                raise GeoEDFError('Join key %s not found in %s in MergeCSVFiles' % (key,os.path.split(csv_file)[1]))
+
+        while True:
+            part_files = [open(self.partition_path(scratch_dir,part_num,file_num),'w') for part_num in range(self.partitions)]
+            try:
+                for part_file in part_files:
+                    pd.DataFrame(columns=columns).to_csv(part_file,index=False)
+                for chunk in pd.read_csv(csv_file,chunksize=self.chunksize,dtype=key_dtypes):
+                    part_nums = pd.util.hash_pandas_object(chunk[self.join_keys],index=False).values % self.partitions
+                    for part_num, part_df in chunk.groupby(part_nums):
+                        part_df.to_csv(part_files[part_num],header=False,index=False)
+                return key_dtypes
+            except (ValueError,TypeError):
+                widened = self.widen_dtypes(csv_file,key_dtypes)
+                if widened == key_dtypes:
+                    raise
+                key_dtypes = widened
+            finally:
+                for part_file in part_files:
+                    part_file.close()
+
+    # join a single partition across all input files; rows with the same keys always end up in
+    # the same partition, so each partition can be joined independently and only one is held in memory
+    # non-key columns shared between files are suffixed with the name of the later file
+    # partitions are read with the schema each file was partitioned with
+    def join_partition(self,part_num,file_tags,file_dtypes,scratch_dir):
+
+        joined_df = None
+        for (file_num, file_tag) in file_tags:
+            part_df = pd.read_csv(self.partition_path(scratch_dir,part_num,file_num),dtype=file_dtypes[file_num])
+            if joined_df is None:
+                joined_df = part_df
+            else:
+                joined_df = joined_df.merge(part_df,how='outer',on=self.join_keys,suffixes=('','_%s' % file_tag))
+        joined_path = '%s/joined%d.csv' % (scratch_dir,part_num)
+        joined_df.to_csv(joined_path,index=False)
+        return joined_path
+
+    # name of a CSV file without its (optionally compressed) CSV extension
+    def file_tag(self,csv_file):
+        filename = os.path.split(csv_file)[1]
+        for extension in sorted(self.__csv_extensions,key=len,reverse=True):
+            if filename.endswith(extension):
+                return filename[:-len(extension)]
+        return os.path.splitext(filename)[0]
+
+    # copy the joined partitions to the output file as they are, writing the header only once;
+    # all partitions are joined from the same files, so they have the same columns
+    def stream_partitions(self,joined_paths,output_path):
+        with open(output_path,'w') as output_file:
+            for (part_num, joined_path) in enumerate(joined_paths):
+                with open(joined_path,'r') as joined_file:
+                    header = joined_file.readline()
+                    if part_num == 0:
+                        output_file.write(header)
+                    shutil.copyfileobj(joined_file,output_file)
+
+    # out-of-core keyed outer join of all CSV files
+    # files are first hash partitioned on the join keys into a scratch directory, the partitions are
+    # then joined in parallel and the joined partitions streamed to the output file
+    def join_files(self,csv_files,output_path):
+
+        # skip empty files
+        file_tags = []
+        for file_num, csv_file in enumerate(csv_files):
+            try:
+                pd.read_csv(csv_file,nrows=0)
+                file_tags.append((file_num,self.file_tag(csv_file)))
+            except pd.errors.EmptyDataError:
+                pass
+        if len(file_tags) == 0:
+            raise GeoEDFError('No CSV files with data found to join in MergeCSVFiles')
+
+        # scratch space defaults to the output directory; it is removed once the join is done
+        if self.scratch_dir is not None:
+            scratch_dir = tempfile.mkdtemp(dir=self.scratch_dir)
+        else:
+            scratch_dir = tempfile.mkdtemp(dir=self.target_path)
+        try:
+            schemas = Parallel(n_jobs=self.n_jobs)(delayed(self.partition_file)(file_num,csv_files[file_num],scratch_dir) for (file_num, ignore) in file_tags)
+            file_dtypes = dict(zip([file_num for (file_num, ignore) in file_tags],schemas))
+            # joined partitions are held in memory, so few enough are joined at once that together
+            # they hold no more than 1/16th of the input, whatever the number of cores
+            join_jobs = max(1,min(effective_n_jobs(self.n_jobs),self.partitions // self.__partitions_per_job))
+            joined_paths = Parallel(n_jobs=join_jobs)(delayed(self.join_partition)(part_num,file_tags,file_dtypes,scratch_dir) for part_num in range(self.partitions))
+            self.stream_partitions(joined_paths,output_path)
+        finally:
+            shutil.rmtree(scratch_dir,ignore_errors=True)
+
     # each Process plugin needs to implement this method
     # if error, raise exception; if not, return True
     def process(self):
@@ -50,21 +367,58 @@ class MergeCSVFiles(GeoEDFPlugin):
             output_path = '%s/%s.csv' % (self.target_path,self.basename)
         else:
             output_path = '%s/output.csv' % self.target_path
+
+        # find the files to process and infer their common schema
+        try:
+            csv_files = self.list_csv_files()
+            self.dtypes = self.infer_dtypes(csv_files)
+        except GeoEDFError:
+            raise
+        except:
+            raise GeoEDFError('Error listing and sampling CSV files in MergeCSVFiles')
+
+        # stream the files to the output without materializing the result
+        if self.mode == 'concat':
+            try:
+                self.concat_files(csv_files,output_path,self.dtypes)
+            except:
+                raise GeoEDFError('Error concatenating CSV files in MergeCSVFiles')
+            return True
+
+        # keyed join, never holding more than one partition of the inputs in memory
+        if self.join_keys is not None:
+            try:
+                self.join_files(csv_files,output_path)
+            except GeoEDFError:
+                raise
+            except:
+                raise GeoEDFError('Error joining CSV files in MergeCSVFiles')
+            return True
        
         merge_df = None
+
+        # parse the files in parallel; the C and pyarrow parsers release the GIL, so threads are used
+        try:
+            results = Parallel(n_jobs=self.n_jobs,prefer='threads')(delayed(self.read_csv_file)(csv_file) for csv_file in csv_files)
+        except:
+            raise GeoEDFError('Error reading CSV files in MergeCSVFiles')
+
+        # files that did not fit the schema were read with a widened one; the other files are
+        # cast to match, so that the columns being merged on have the same types
+        dtypes = self.widest_dtypes([file_dtypes for (df, file_dtypes) in results if df is not None])
         
         # loop through files
-        for file_or_dir in os.listdir(self.filepath):
-            if file_or_dir.endswith('.csv'):
-                fullpath = '%s/%s' % (self.filepath,file_or_dir)
-                try:
-                    df = pd.read_csv(fullpath)
-                    if merge_df is None:
-                        merge_df = df
-                    else:
-                        merge_df = merge_df.merge(df,how='outer')
-                except pd.errors.EmptyDataError:
-                    pass
+        for (df, file_dtypes) in results:
+            # skip empty files
+            if df is None:
+                continue
+            casts = dict([(column,dtypes[column]) for column in df.columns if column in file_dtypes and file_dtypes[column] != dtypes[column]])
+            if len(casts) > 0:
+                df = df.astype(casts)
+            if merge_df is None:
+                merge_df = df
+            else:
+                merge_df = merge_df.merge(df,how='outer')
         #write out to output
         merge_df.to_csv(output_path,index=False)
                 
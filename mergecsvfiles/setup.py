@@ -8,5 +8,5 @@ setup(name='MergeCSVFiles',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
-      install_requires=['pandas'],
+      install_requires=['pandas','joblib','pyarrow','zstandard'],
       zip_safe=False)
@@ -5,19 +5,33 @@ from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
+import json
+import shutil
+import hashlib
 
 """ Module for implementing the processor for merging per-station GHCND data. This plugin will process 
     a directory containing per-station,per-parameter CSV files. It merges the data, producing a single CSV
     file for each parameter. Each column in this result CSV corresponds to a station.
+    If the output of a previous run is provided, only new or changed station files are merged into it.
+    Alternatively, the data can be streamed into a single long-format (date, station, param, value) 
+    Parquet file, keeping memory bounded regardless of the number of stations.
 """
 
 class MergeGHCNDData(GeoEDFPlugin):
 
     # GHCND params are hardcoded for now
-    __optional_params = []
+    # merged_dir is the output directory of a previous run; if provided, the run is incremental
+    # change_detection is one of mtime (default) or hash
+    # output_format is one of wide (default; one CSV per param) or long (single Parquet file)
+    __optional_params = ['merged_dir','change_detection','output_format','categorical','row_group_size']
     __required_params = ['data_dir']
 
+    # manifest recording the station files that went into a merged output
+    __manifest_filename = 'ghcnd_manifest.json'
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFInput super class
     def __init__(self, **kwargs):
@@ -40,6 +54,31 @@ class MergeGHCNDData(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
             
+        # station files are compared by modification time and size unless hashing is requested
+        if self.change_detection is None:
+            self.change_detection = 'mtime'
+        if self.change_detection not in ['mtime','hash']:
+            raise GeoEDFError('change_detection for MergeGHCNDData must be one of mtime or hash')
+
+        # the wide per-param CSV layout is produced unless the long format is requested
+        if self.output_format is None:
+            self.output_format = 'wide'
+        if self.output_format not in ['wide','long']:
+            raise GeoEDFError('output_format for MergeGHCNDData must be one of wide or long')
+        if self.output_format == 'long' and self.merged_dir is not None:
+            raise GeoEDFError('Incremental merging is only supported for the wide output_format in MergeGHCNDData')
+
+        # long format options; station and param labels are dictionary encoded if categorical
+        self.categorical = str(self.categorical).lower() in ['true','yes','1']
+        try:
+            if self.row_group_size is None:
+                self.row_group_size = 1000000
+            self.row_group_size = int(self.row_group_size)
+            if self.row_group_size < 1:
+                raise ValueError
+        except ValueError:
+            raise GeoEDFError('row_group_size for MergeGHCNDData must be a positive integer')
+
         # set the hardcoded set of meterological params
         # can possibly generalize to fetch any list of params in the future
         self.met_params = ['SNOW','SNWD','TMAX','TMIN','PRCP']
@@ -47,6 +86,141 @@ class MergeGHCNDData(GeoEDFPlugin):
         # class super class init
         super().__init__()
 
+    # fingerprint a station file so that changes can be detected in a subsequent run
+    def station_fingerprint(self,station_file):
+        file_stat = os.stat(station_file)
+        fingerprint = {'mtime': file_stat.st_mtime, 'size': file_stat.st_size}
+        if self.change_detection == 'hash':
+            file_hash = hashlib.sha256()
+            with open(station_file,'rb') as station_fileobj:
+                for block in iter(lambda: station_fileobj.read(1024*1024), b''):
+                    file_hash.update(block)
+            fingerprint['sha256'] = file_hash.hexdigest()
+        return fingerprint
+
+    # determine if a station file differs from the one recorded in a previous manifest
+    def station_changed(self,fingerprint,prev_fingerprint):
+        if prev_fingerprint is None:
+            return True
+        if self.change_detection == 'hash':
+            return fingerprint.get('sha256') != prev_fingerprint.get('sha256')
+        return (fingerprint['mtime'] != prev_fingerprint.get('mtime')) or (fingerprint['size'] != prev_fingerprint.get('size'))
+
+    # load the manifest of a previous run; an empty manifest means every station file is new
+    def read_manifest(self,merged_dir):
+        manifest_file = '%s/%s' % (merged_dir,self.__manifest_filename)
+        if not os.path.isfile(manifest_file):
+            print('MergeGHCNDData: no manifest found in %s, treating all station files as new' % merged_dir)
+            return dict()
+        try:
+            with open(manifest_file,'r') as manifest_fileobj:
+                return json.load(manifest_fileobj)
+        except:
+            raise GeoEDFError('Error reading manifest %s in MergeGHCNDData' % manifest_file)
+
+    # read a station file into a DF indexed by date, with the data column renamed to the station ID
+    def read_station_file(self,station_file,met_param):
+        station_df = pd.read_csv(station_file)
+        # get rid of dummy index
+        station_df.set_index(pd.to_datetime(station_df['date']), inplace=True)
+        # extract station ID to use as column name
+        station_filename = os.path.split(station_file)[1]
+        basename = os.path.splitext(station_filename)[0]
+        station_id = basename.split('_')[0]
+        # now keep only the data column
+        station_df = station_df.filter([met_param])
+        # rename data column to station ID
+        # this is so that we can merge individual station DFs via outer joins
+        return station_df.rename(columns={met_param: station_id})
+
+    # merge a list of station files for a param into a single DF, one column per station
+    def merge_station_files(self,station_files,met_param):
+        merged_df = pd.DataFrame()
+        for station_file in station_files:
+            station_df = self.read_station_file(station_file,met_param)
+            if merged_df.empty:
+                merged_df = station_df
+            else:
+                merged_df = merged_df.merge(station_df,how='outer',left_index=True,right_index=True)
+        return merged_df
+
+    # load a previously merged param DF; missing outputs are treated as empty
+    def read_merged_file(self,merged_file):
+        if not os.path.isfile(merged_file):
+            return pd.DataFrame()
+        try:
+            return pd.read_csv(merged_file,index_col=0,parse_dates=True)
+        except pd.errors.EmptyDataError:
+            return pd.DataFrame()
+
+    # replace or add the columns of the given stations in a previously merged DF
+    # new dates are added as rows; the outer join leaves NaN for them in untouched stations
+    def upsert_stations(self,merged_df,station_df):
+        if merged_df.empty:
+            return station_df
+        stale_columns = [col for col in station_df.columns if col in merged_df.columns]
+        merged_df = merged_df.drop(columns=stale_columns)
+        return merged_df.merge(station_df,how='outer',left_index=True,right_index=True)
+
+    # build an array of a repeated station or param label for the long format
+    def label_array(self,label,num_rows):
+        label_arr = pa.array([label]*num_rows,type=pa.string())
+        if self.categorical:
+            return label_arr.dictionary_encode()
+        return label_arr
+
+    # stream all station files into a long-format Parquet file, one row per date, station and param
+    # rows are buffered and flushed in row groups so only one row group is ever held in memory
+    # missing values are left out rather than filled with zeros
+    def write_long_format(self,met_param_files):
+
+        if self.categorical:
+            label_type = pa.dictionary(pa.int32(),pa.string())
+        else:
+            label_type = pa.string()
+        long_schema = pa.schema([('date',pa.date32()),('station',label_type),('param',label_type),('value',pa.float64())])
+
+        long_datafile = '%s/ghcnd_long.parquet' % self.target_path
+        try:
+            writer = pq.ParquetWriter(long_datafile,long_schema)
+        except:
+            raise GeoEDFError('Error creating long format output file in MergeGHCNDData')
+
+        try:
+            batches = []
+            num_buffered = 0
+            for met_param in self.met_params:
+                for station_file in met_param_files[met_param]:
+                    try:
+                        station_df = self.read_station_file(station_file,met_param).dropna()
+                    except:
+                        raise GeoEDFError('Error reading station file %s in MergeGHCNDData' % station_file)
+                    # station file without this param's data column
+                    if len(station_df.columns) == 0 or station_df.empty:
+                        continue
+                    station_id = station_df.columns[0]
+                    num_rows = station_df.shape[0]
+                    batches.append(pa.RecordBatch.from_arrays([pa.array(station_df.index.values.astype('datetime64[D]'),type=pa.date32()),
+                                                               self.label_array(station_id,num_rows),
+                                                               self.label_array(met_param,num_rows),
+                                                               pa.array(station_df[station_id].values,type=pa.float64())],
+                                                              schema=long_schema))
+                    num_buffered += num_rows
+                    # flush a full row group
+                    if num_buffered >= self.row_group_size:
+                        writer.write_table(pa.Table.from_batches(batches,schema=long_schema),row_group_size=self.row_group_size)
+                        batches = []
+                        num_buffered = 0
+            # flush remaining rows
+            if num_buffered > 0:
+                writer.write_table(pa.Table.from_batches(batches,schema=long_schema),row_group_size=self.row_group_size)
+        except GeoEDFError:
+            raise
+        except:
+            raise GeoEDFError('Error writing out long format data in MergeGHCNDData')
+        finally:
+            writer.close()
+
     # each Process plugin needs to implement this method
     # if error, raise exception; if not, return True
     def process(self):
@@ -61,6 +235,12 @@ class MergeGHCNDData(GeoEDFPlugin):
             met_param_files[met_param] = []
             met_param_data[met_param] = pd.DataFrame()
                 
+        # in incremental mode, the manifest of the previous run determines which files are merged
+        if self.merged_dir is not None:
+            manifest = self.read_manifest(self.merged_dir)
+        else:
+            manifest = dict()
+
         # loop through files
         for file_or_dir in os.listdir(self.data_dir):
             if file_or_dir.endswith('.csv'):
@@ -69,30 +249,37 @@ class MergeGHCNDData(GeoEDFPlugin):
                     station_id,param = basename.split('_',maxsplit=2)
                     if param in self.met_params:
                         fullpath = '%s/%s' % (self.data_dir,file_or_dir)
+                        if self.output_format == 'long':
+                            met_param_files[param].append(fullpath)
+                            continue
+                        fingerprint = self.station_fingerprint(fullpath)
+                        # skip files that are unchanged since the previous run
+                        if self.merged_dir is not None and not self.station_changed(fingerprint,manifest.get(file_or_dir)):
+                            continue
+                        manifest[file_or_dir] = fingerprint
                         met_param_files[param].append(fullpath)
                 except ValueError:
                     print('File %s not being processed; does not match pattern' % file_or_dir)
+
+        # long format is streamed straight to the output file
+        if self.output_format == 'long':
+            self.write_long_format(met_param_files)
+            return True
                         
         # now for each param merge the data frames
         for met_param in self.met_params:
             try:
-                for station_file in met_param_files[met_param]:
-                    station_df = pd.read_csv(station_file)
-                    # get rid of dummy index
-                    station_df.set_index(pd.to_datetime(station_df['date']), inplace=True)
-                    # extract station ID to use as column name
-                    station_filename = os.path.split(station_file)[1]
-                    basename = os.path.splitext(station_filename)[0]
-                    station_id = basename.split('_')[0]
-                    # now keep only the data column
-                    station_df = station_df.filter([met_param])
-                    # rename data column to station ID
-                    # this is so that we can merge individual station DFs via outer joins
-                    station_df = station_df.rename(columns={met_param: station_id})
-                    if met_param_data[met_param].empty:
-                        met_param_data[met_param] = station_df
-                    else:
-                        met_param_data[met_param] = met_param_data[met_param].merge(station_df,how='outer',left_index=True,right_index=True)
+                if self.merged_dir is not None:
+                    # nothing changed for this param, the previous output is reused as is
+                    if len(met_param_files[met_param]) == 0:
+                        met_param_data[met_param] = None
+                        continue
+                    print('MergeGHCNDData: updating %d stations for param %s' % (len(met_param_files[met_param]),met_param))
+                    prev_datafile = '%s/%s.csv' % (self.merged_dir,met_param)
+                    station_df = self.merge_station_files(met_param_files[met_param],met_param)
+                    met_param_data[met_param] = self.upsert_stations(self.read_merged_file(prev_datafile),station_df)
+                else:
+                    met_param_data[met_param] = self.merge_station_files(met_param_files[met_param],met_param)
                 # fill NaN with zeros
                 met_param_data[met_param] = met_param_data[met_param].fillna(value=0)
             except:
@@ -102,9 +289,22 @@ class MergeGHCNDData(GeoEDFPlugin):
         for met_param in self.met_params:
             try:
                 met_param_datafile = '%s/%s.csv' % (self.target_path,met_param)
-                met_param_data[met_param].to_csv(met_param_datafile)
+                if met_param_data[met_param] is None:
+                    prev_datafile = '%s/%s.csv' % (self.merged_dir,met_param)
+                    if os.path.isfile(prev_datafile):
+                        shutil.copyfile(prev_datafile,met_param_datafile)
+                else:
+                    met_param_data[met_param].to_csv(met_param_datafile)
             except:
                 raise GeoEDFError('Error writing out data frame for param %s in MergeGHCNDData' % met_param)
+
+        # record the station files merged so far so that the next run can be incremental
+        try:
+            manifest_file = '%s/%s' % (self.target_path,self.__manifest_filename)
+            with open(manifest_file,'w') as manifest_fileobj:
+                json.dump(manifest,manifest_fileobj)
+        except:
+            raise GeoEDFError('Error writing out manifest in MergeGHCNDData')
                 
         return True
             
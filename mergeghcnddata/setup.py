@@ -8,5 +8,5 @@ setup(name='mergeghcnddata',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
-      install_requires=['pandas'],
+      install_requires=['pandas','pyarrow'],
       zip_safe=False)
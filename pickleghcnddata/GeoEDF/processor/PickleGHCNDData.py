@@ -5,18 +5,30 @@ from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
 import pandas as pd
+import numpy as np
 import os
 import pickle
+from joblib import Parallel, delayed
+
+from .helper import GHCNDStore
 
 """ Module for implementing the processor for creating a pickle file from rolling 7 and 30-day windows of 
     per-parameter GHCND data. This plugin assumes the files are named <param>.csv. This plugin will process 
     a directory containing these per-parameter CSV files. It creates one pickle file per parameter. 
+    The per-station files normally merged by MergeGHCNDData can also be processed directly, in which 
+    case the merged data is kept in memory (or memory-mapped scratch) rather than written out.
+    Alternatively, a compact store can be produced that holds the data matrix of each parameter once 
+    as a memory-mappable .npy file, with the lag and window definitions kept as metadata.
 """
 
 class PickleGHCNDData(GeoEDFPlugin):
 
     # GHCND params are hardcoded for now
-    __optional_params = []
+    # output_format is one of pickle (default) or npy
+    # windows, lags and reducers default to 30 and 7-day sums and a lag of 1
+    # n_jobs is the number of params processed in parallel
+    # input_layout is one of merged (default; <param>.csv files) or station (<station>_<param>.csv files)
+    __optional_params = ['output_format','windows','lags','reducers','n_jobs','input_layout','scratch_dir','write_merged']
     __required_params = ['data_dir']
 
     # we use just kwargs since we need to be able to process the list of attributes
@@ -41,65 +53,216 @@ class PickleGHCNDData(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
             
+        # pickle files are produced unless the compact npy store is requested
+        if self.output_format is None:
+            self.output_format = 'pickle'
+        if self.output_format not in ['pickle','npy']:
+            raise GeoEDFError('output_format for PickleGHCNDData must be one of pickle or npy')
+
+        # per-param merged CSV files are expected unless per-station files are to be merged first
+        if self.input_layout is None:
+            self.input_layout = 'merged'
+        if self.input_layout not in ['merged','station']:
+            raise GeoEDFError('input_layout for PickleGHCNDData must be one of merged or station')
+        # only write out the merged CSV files when requested
+        self.write_merged = str(self.write_merged).lower() in ['true','yes','1']
+
         # set the hardcoded set of meterological params
         self.met_params = ['SNOW','SNWD','TMAX','TMIN','PRCP']
 
+        # lag and rolling window (in days) definitions
+        try:
+            self.windows = [int(window) for window in self.parse_list(self.windows,[30,7])]
+            self.lags = [int(lag) for lag in self.parse_list(self.lags,[1])]
+        except ValueError:
+            raise GeoEDFError('windows and lags for PickleGHCNDData must be lists of integers')
+        if min(self.windows + self.lags) < 1:
+            raise GeoEDFError('windows and lags for PickleGHCNDData must be positive')
+        self.reducers = self.parse_list(self.reducers,['sum'])
+        for reducer in self.reducers:
+            if reducer not in GHCNDStore.REDUCERS:
+                raise GeoEDFError('Unsupported reducer %s for PickleGHCNDData, must be one of %s' % (reducer,','.join(GHCNDStore.REDUCERS)))
+        # repeated entries would produce datasets with the same name
+        for (name, values) in [('windows',self.windows),('lags',self.lags),('reducers',self.reducers)]:
+            if len(set(values)) != len(values):
+                raise GeoEDFError('%s for PickleGHCNDData must not contain duplicates' % name)
+
+        # number of leading rows used only to warm up lags and windows
+        self.offset = GHCNDStore.warmup_offset(self.lags,self.windows)
+
+        # process all params in parallel by default
+        try:
+            if self.n_jobs is None:
+                self.n_jobs = -1
+            self.n_jobs = int(self.n_jobs)
+        except ValueError:
+            raise GeoEDFError('n_jobs for PickleGHCNDData must be an integer')
+
         # class super class init
         super().__init__()
 
+    # list valued params can be provided as a list or a comma separated string
+    def parse_list(self,value,default):
+        if value is None:
+            return default
+        if isinstance(value,(list,tuple)):
+            return list(value)
+        return [item.strip() for item in str(value).split(',') if item.strip() != '']
+
+    # load the merged <param>.csv file into a list of dates, list of stations and data matrix
+    # returns None if this param file does not exist
+    def load_merged_data(self,met_param):
+
+        # check to see if this param file exists
+        fullpath = '%s/%s.csv' % (self.data_dir,met_param)
+        if not os.path.isfile(fullpath):
+            return None
+
+        # load into DF
+        met_df = pd.read_csv(fullpath)
+        
+        # fill nulls
+        met_df = met_df.fillna(value=0)
+
+        # no records for this param
+        if met_df.shape[0] == 0:
+            return (np.array([],dtype=object), [], np.zeros((0,0),dtype=np.float64))
+
+        # split the date column from the station data matrix
+        dates = met_df['date'].values
+        met_df = met_df.drop(columns=['date'])
+        return (dates, list(met_df.columns), met_df.values.astype(np.float64))
+
+    # merge the per-station <station>_<param>.csv files in data_dir straight into a data matrix
+    # with one row per date and one column per station; missing values are filled with zeros
+    # files are picked and merged exactly as MergeGHCNDData does: in directory listing order, adding
+    # the dates of station files without this param as rows, and starting over whenever the merge
+    # so far has no rows or no station columns (as the outer joins on an empty DF do)
+    # the matrix is memory-mapped in scratch_dir if provided; note that this only keeps the merged matrix
+    # out of memory, the datasets of the pickle output are still built in memory
+    # returns None if there are no station files for this param
+    def merge_station_data(self,met_param):
+
+        station_files = []
+        for filename in os.listdir(self.data_dir):
+            if filename.endswith('.csv'):
+                name_parts = os.path.splitext(filename)[0].split('_',maxsplit=2)
+                if len(name_parts) == 2 and name_parts[1] == met_param:
+                    station_files.append((name_parts[0],filename))
+        if len(station_files) == 0:
+            return None
+
+        # read each station file once, keeping only its dates and values
+        stations = []
+        station_data = []
+        date_arrays = []
+        for (station_id, station_file) in station_files:
+            station_df = pd.read_csv('%s/%s' % (self.data_dir,station_file))
+            station_dates = pd.to_datetime(station_df['date']).values
+            if met_param in station_df.columns:
+                station_cols = [station_id]
+                station_vals = [(station_dates,station_df[met_param].fillna(value=0).values)]
+            else:
+                station_cols = []
+                station_vals = []
+            merged_rows = sum([len(dates) for dates in date_arrays])
+            if merged_rows == 0 or len(stations) == 0:
+                stations = station_cols
+                station_data = station_vals
+                date_arrays = [station_dates]
+            else:
+                stations += station_cols
+                station_data += station_vals
+                date_arrays.append(station_dates)
+
+        # union of dates across stations, then place each station's values in its column
+        all_dates = np.unique(np.concatenate(date_arrays))
+        if len(stations) == 0 and len(all_dates) == 0:
+            return (np.array([],dtype=object), [], np.zeros((0,0),dtype=np.float64))
+        if self.scratch_dir is not None and len(stations) > 0 and len(all_dates) > 0:
+            scratch_file = '%s/%s_merged.dat' % (self.scratch_dir,met_param)
+            data = np.memmap(scratch_file,dtype=np.float64,mode='w+',shape=(len(all_dates),len(stations)))
+            data[:] = 0
+        else:
+            data = np.zeros((len(all_dates),len(stations)),dtype=np.float64)
+        for col, (station_dates, station_vals) in enumerate(station_data):
+            data[np.searchsorted(all_dates,station_dates),col] = station_vals
+        station_data = None
+
+        dates = pd.DatetimeIndex(all_dates,name='date')
+
+        # optionally write out the merged matrix in the same layout as MergeGHCNDData
+        if self.write_merged:
+            merged_datafile = '%s/%s.csv' % (self.target_path,met_param)
+            pd.DataFrame(data,index=dates,columns=stations).to_csv(merged_datafile)
+
+        return (dates.strftime('%Y-%m-%d').values.astype(object), stations, data)
+
+    # create the pickle file (or compact store) for a single param
+    def process_param(self,met_param):
+
+        try:
+            if self.input_layout == 'station':
+                met_data = self.merge_station_data(met_param)
+            else:
+                met_data = self.load_merged_data(met_param)
+        except:
+            raise GeoEDFError("Error loading data for %s in PickleGHCNDData" % met_param)
+        if met_data is None:
+            return
+        (dates, stations, data) = met_data
+
+        try:
+            self.write_param(met_param,dates,stations,data)
+        finally:
+            # discard the memory-mapped scratch matrix
+            if isinstance(data,np.memmap):
+                data = None
+                os.remove('%s/%s_merged.dat' % (self.scratch_dir,met_param))
+
+    # write out the pickle file (or compact store) for the data matrix of a single param
+    def write_param(self,met_param,dates,stations,data):
+        
+        # make sure we have enough rows to warm up the lags and windows (32 for the default 30 day window)
+        num_rows = data.shape[0]
+        
+        if num_rows < self.offset:
+            print("PickleGHCNDData: Cannot create pickle file for %s due to insufficient data records, need atleast %d" % (met_param,self.offset))
+            return
+
+        # the compact store holds the data matrix once, windows are computed on load
+        if self.output_format == 'npy':
+            store_prefix = '%s/%s_HUC2' % (self.target_path,met_param)
+            GHCNDStore.write_store(store_prefix,met_param,dates,stations,data,self.offset,self.lags,self.windows,self.reducers)
+        else:
+            # continue with getting rolling windows
+            # all windows are computed together in one pass over the data matrix
+            try:
+                # create dictionary to output to pickle file
+                specs = GHCNDStore.dataset_specs(met_param,self.lags,self.windows,self.reducers)
+                datasets = dict(zip([spec[0] for spec in specs],GHCNDStore.build_datasets(specs,dates,stations,data,self.offset)))
+            except:
+                raise GeoEDFError("Error occurred computing rolling windows for %s in PickleGHCNDData" % met_param)
+                
+            out_dict = {'Data_all':list(datasets.values()), 'df_name':list(datasets.keys())}
+            
+            # output to file
+            try:
+                pickle_filename = '%s/%s_HUC2.p' % (self.target_path,met_param)
+                with open(pickle_filename,'wb') as pickle_file:
+                    pickle.dump(out_dict,pickle_file)
+            except:
+                raise GeoEDFError("Error writing out pickle file for %s in PickleGHCNDData" % met_param)
+
     # each Process plugin needs to implement this method
     # if error, raise exception; if not, return True
     def process(self):
 
         # Not much validation, only process csv files with names matching the 
-        # param.csv pattern
+        # param.csv (or stationID_param.csv) pattern
         # load the data into Pandas dataframe and create the rolling windows
-        for met_param in self.met_params:
-            # check to see if this param file exists
-            fullpath = '%s/%s.csv' % (self.data_dir,met_param)
-            if os.path.isfile(fullpath):
-                # load into DF
-                met_df = pd.read_csv(fullpath)
-                
-                # fill nulls
-                met_df = met_df.fillna(value=0)
-                
-                #since we want 7 and 30 day windows, make sure we have atleast 32 rows
-                num_rows = met_df.shape[0]
-                
-                if num_rows < 32:
-                    print("PickleGHCNDData: Cannot create pickle file for %s due to insufficient data records, need atleast 32" % met_param)
-                    continue
-                # continue with getting rolling windows
-                try:
-                    met_df_origin = met_df[32:]
-                    met_df_lag1 = met_df[31:-1]
-                    met_df_30day = met_df.rolling(window=30).sum()
-                    met_df_7day = met_df.rolling(window=7).sum()
-                
-                    # moving averages
-                    met_df_30day = met_df_30day[32:]
-                    met_df_7day = met_df_7day[32:]
-                    
-                except:
-                    raise GeoEDFError("Error occurred computing rolling windows for %s in PickleGHCNDData" % met_param)
-                    
-                # create dictionary to output to pickle file
-                datasets = {}
-                datasets[met_param] = met_df_origin
-                datasets[met_param+'_lag1'] = met_df_lag1
-                datasets[met_param+'_30D'] = met_df_30day
-                datasets[met_param+'_7D'] = met_df_7day
-                
-                out_dict = {'Data_all':list(datasets.values()), 'df_name':list(datasets.keys())}
-                
-                # output to file
-                try:
-                    pickle_filename = '%s/%s_HUC2.p' % (self.target_path,met_param)
-                    with open(pickle_filename,'wb') as pickle_file:
-                        pickle.dump(out_dict,pickle_file)
-                except:
-                    raise GeoEDFError("Error writing out pickle file for % in PickleGHCNDData" % met_param)
+        # params are independent of each other and are processed in parallel
+        Parallel(n_jobs=self.n_jobs)(delayed(self.process_param)(met_param) for met_param in self.met_params)
                     
         return True
             
@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+from collections.abc import Sequence
+
+import numpy as np
+import pandas as pd
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for building and storing the lag and rolling window datasets of a 
+    GHCND parameter. The compact store keeps the base matrix of a parameter once as 
+    a NumPy .npy file next to a JSON file with its dates, stations and window definitions. 
+    The loader memory-maps the matrix and only materializes the Data_all/df_name 
+    datasets written by PickleGHCNDData when they are accessed.
+"""
+
+# reducers supported for rolling windows
+REDUCERS = ['sum','mean','max']
+
+# list of (dataset name, kind, size, reducer) tuples in the order they appear in Data_all
+# rolling sums keep the <param>_<window>D name, other reducers are suffixed to it
+# reducers default to just sum
+def dataset_specs(met_param,lags,windows,reducers=None):
+    if reducers is None:
+        reducers = ['sum']
+    specs = [(met_param,'origin',0,None)]
+    for lag in lags:
+        specs.append(('%s_lag%d' % (met_param,lag),'lag',lag,None))
+    for window in windows:
+        for reducer in reducers:
+            if reducer == 'sum':
+                specs.append(('%s_%dD' % (met_param,window),'window',window,reducer))
+            else:
+                specs.append(('%s_%dD_%s' % (met_param,window,reducer),'window',window,reducer))
+    return specs
+
+# number of leading rows used only to warm up the lags and windows
+# this is 32 for the default 30-day window and lag of 1
+def warmup_offset(lags,windows):
+    return max(list(lags) + list(windows)) + 2
+
+# compute rolling windows over the rows of the data matrix for rows offset onwards
+# all sums and means are taken from a single cumulative sum over every station column;
+# maxima are reduced over a strided (non-copying) view of the trailing window rows
+# returns a dict keyed by (window, reducer)
+def rolling_windows(data,windows,reducers,offset):
+    data = np.ascontiguousarray(data,dtype=np.float64)
+    num_rows = data.shape[0]
+    window_data = dict()
+
+    if 'sum' in reducers or 'mean' in reducers:
+        cumsum = np.zeros((num_rows+1,data.shape[1]),dtype=np.float64)
+        np.cumsum(data,axis=0,out=cumsum[1:])
+        for window in windows:
+            window_sum = cumsum[offset+1:] - cumsum[offset+1-window:num_rows+1-window]
+            if 'sum' in reducers:
+                window_data[(window,'sum')] = window_sum
+            if 'mean' in reducers:
+                window_data[(window,'mean')] = window_sum / window
+
+    if 'max' in reducers:
+        for window in windows:
+            start = offset - window + 1
+            window_view = np.lib.stride_tricks.as_strided(data[start:],
+                                                          shape=(num_rows-offset,window,data.shape[1]),
+                                                          strides=(data.strides[0],data.strides[0],data.strides[1]),
+                                                          writeable=False)
+            window_data[(window,'max')] = window_view.max(axis=1)
+
+    return window_data
+
+# build the DFs for a list of dataset specs; rows before offset are only used to warm up lags and windows
+# origin and lag datasets keep the date column, rolling windows only contain station columns
+def build_datasets(specs,dates,stations,data,offset):
+    num_rows = data.shape[0]
+    window_specs = [spec for spec in specs if spec[1] == 'window']
+    window_data = rolling_windows(data,
+                                  sorted(set([spec[2] for spec in window_specs])),
+                                  sorted(set([spec[3] for spec in window_specs])),
+                                  offset)
+    datasets = []
+    for (ignore, kind, size, reducer) in specs:
+        if kind == 'window':
+            datasets.append(pd.DataFrame(window_data[(size,reducer)],columns=stations,index=pd.RangeIndex(offset,num_rows)))
+        else:
+            start = offset - size
+            end = num_rows - size
+            dataset_df = pd.DataFrame(data[start:end],columns=stations,index=pd.RangeIndex(start,end))
+            dataset_df.insert(0,'date',dates[start:end])
+            datasets.append(dataset_df)
+    return datasets
+
+# build the DF for a single dataset
+def materialize(spec,dates,stations,data,offset):
+    return build_datasets([spec],dates,stations,data,offset)[0]
+
+# write the base matrix and its metadata to <store_prefix>.npy and <store_prefix>.json
+def write_store(store_prefix,met_param,dates,stations,data,offset,lags,windows,reducers=None):
+    if reducers is None:
+        reducers = ['sum']
+    try:
+        np.save('%s.npy' % store_prefix,np.ascontiguousarray(data,dtype=np.float64))
+        metadata = {'param': met_param,
+                    'dates': list(dates),
+                    'stations': list(stations),
+                    'offset': offset,
+                    'lags': list(lags),
+                    'windows': list(windows),
+                    'reducers': list(reducers)}
+        with open('%s.json' % store_prefix,'w') as meta_file:
+            json.dump(metadata,meta_file)
+    except:
+        raise GeoEDFError('Error writing out compact store %s' % store_prefix)
+
+class LazyDatasets(Sequence):
+    """ Sequence of the datasets of a compact store; each DF is built when accessed
+    """
+
+    def __init__(self,specs,dates,stations,data,offset):
+        self.specs = specs
+        self.dates = dates
+        self.stations = stations
+        self.data = data
+        self.offset = offset
+
+    def __len__(self):
+        return len(self.specs)
+
+    def __getitem__(self,index):
+        if isinstance(index,slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return materialize(self.specs[index],self.dates,self.stations,self.data,self.offset)
+
+# load a compact store into the {'Data_all': ..., 'df_name': ...} structure of the pickle files
+# store_prefix is the path without the .npy/.json extension, e.g. <dir>/PRCP_HUC2
+def load_store(store_prefix,mmap=True):
+    try:
+        with open('%s.json' % store_prefix,'r') as meta_file:
+            metadata = json.load(meta_file)
+        if mmap:
+            data = np.load('%s.npy' % store_prefix,mmap_mode='r')
+        else:
+            data = np.load('%s.npy' % store_prefix)
+    except:
+        raise GeoEDFError('Error loading compact store %s' % store_prefix)
+
+    specs = dataset_specs(metadata['param'],metadata['lags'],metadata['windows'],metadata.get('reducers',['sum']))
+    datasets = LazyDatasets(specs,np.array(metadata['dates'],dtype=object),metadata['stations'],data,metadata['offset'])
+    return {'Data_all': datasets, 'df_name': [spec[0] for spec in specs]}
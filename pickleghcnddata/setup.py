@@ -8,5 +8,5 @@ setup(name='pickleghcnddata',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
-      install_requires=['pandas'],
+      install_requires=['pandas','numpy','joblib'],
       zip_safe=False)
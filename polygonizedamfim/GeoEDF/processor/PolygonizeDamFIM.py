@@ -4,18 +4,25 @@
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 
-import subprocess
 import os
-from osgeo import gdal
+from osgeo import gdal, ogr, osr
+
+from .helper import TiledPolygonize
 
 """ Module for implementing the PolygonizeDamFIM processor. This accepts a flood inundation map
     GeoTIFF as input and returns a shapefile that has been reclassified and reduced in scale.
+    If tile_size is provided, the map is polygonized in tiles of tile_size pixels on a pool of
+    n_jobs worker processes, and polygons of the same depth are dissolved across tile seams.
 """
 
 class PolygonizeDamFIM(GeoEDFPlugin):
-    __optional_params = []
+    # tile_size enables tiled polygonization, with n_jobs worker processes
+    __optional_params = ['tile_size','n_jobs']
     __required_params = ['rasterfile']
 
+    # resolution the flood inundation map is resampled to, in degrees
+    __resolution = 0.001
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFPlugin super class
     def __init__(self, **kwargs):
@@ -38,6 +45,20 @@ class PolygonizeDamFIM(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
 
+        try:
+            if self.tile_size is not None:
+                self.tile_size = int(self.tile_size)
+                if self.tile_size < 1:
+                    raise ValueError
+        except ValueError:
+            raise GeoEDFError('tile_size for PolygonizeDamFIM must be a positive integer')
+        try:
+            if self.n_jobs is None:
+                self.n_jobs = -1
+            self.n_jobs = int(self.n_jobs)
+        except ValueError:
+            raise GeoEDFError('n_jobs for PolygonizeDamFIM must be an integer')
+
         # class super class init
         super().__init__()
 
@@ -45,14 +66,47 @@ class PolygonizeDamFIM(GeoEDFPlugin):
     # if error, raise exception
     # assume this method is called only when all params have been fully instantiated
     def process(self):
-        
+
+        gdal.UseExceptions()
+
+        filename = self.rasterfile.split("/")[-1].split(".")[-2]
+        geojson_out = "%s/damfim_%s.json" % (self.target_path,filename)
+        if os.path.exists(geojson_out):
+            os.remove(geojson_out)
+
+        if self.tile_size is not None:
+            TiledPolygonize.polygonizeTiled(os.path.abspath(self.rasterfile),geojson_out,self.__resolution,self.tile_size,self.n_jobs)
+            return
+
+        # the resampled raster is only held in memory
+        resampled = "/vsimem/%s.tiff" % filename
+
+        try:
+            warp_ds = gdal.Warp(resampled,self.rasterfile,format='GTiff',xRes=self.__resolution,yRes=self.__resolution,resampleAlg='near')
+        except RuntimeError as err:
+            raise GeoEDFError("Error resampling FIM Tiff %s: %s" % (os.path.split(self.rasterfile)[1],err))
+
         try:
-            filename = self.rasterfile.split("/")[-1].split(".")[-2]
-            geojson_out = "%s/damfim_%s.json" % (self.target_path,filename)
-            save_path = self.target_path +"/"+ filename + ".tiff"
-            subprocess.run(["gdalwarp","-r","near","-of","GTiff","-tr","0.001","0.001",self.rasterfile,save_path])
-            subprocess.run(["gdal_polygonize.py",save_path,geojson_out,"-b","1","damfim","depth"])
-            
-        except:
-            raise GeoEDFError("Error occurred running gdal_polygonize to convert FIM Tiff %s" % os.path.split(self.rasterfile)[1])
-        
+            self.polygonize(warp_ds,geojson_out)
+        except RuntimeError as err:
+            raise GeoEDFError("Error occurred running gdal_polygonize to convert FIM Tiff %s: %s" % (os.path.split(self.rasterfile)[1],err))
+        finally:
+            warp_ds = None
+            gdal.Unlink(resampled)
+
+    # polygonize band 1 of a raster into a GeoJSON layer named damfim, with the
+    # pixel values in a depth field; pixels outside the band's mask are skipped
+    def polygonize(self,raster_ds,geojson_out):
+        band = raster_ds.GetRasterBand(1)
+        srs = None
+        if raster_ds.GetProjection():
+            srs = osr.SpatialReference(wkt=raster_ds.GetProjection())
+
+        out_ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(geojson_out)
+        if out_ds is None:
+            raise GeoEDFError("Error creating GeoJSON output %s" % os.path.split(geojson_out)[1])
+        out_layer = out_ds.CreateLayer('damfim',srs=srs)
+        out_layer.CreateField(ogr.FieldDefn('depth',ogr.OFTInteger))
+
+        gdal.Polygonize(band,band.GetMaskBand(),out_layer,0,[])
+        out_ds = None
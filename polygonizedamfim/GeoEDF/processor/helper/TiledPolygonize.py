@@ -0,0 +1,186 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from osgeo import gdal, ogr, osr
+from joblib import Parallel, delayed, cpu_count
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for polygonizing a large raster in tiles on a pool of worker processes.
+    The raster is resampled through a warped VRT, so that every worker reads its tile
+    of the same output grid. Tiles are polygonized in pixel coordinates of the whole
+    grid, which keeps the vertices on either side of a seam identical. Polygons touching
+    a seam are bucketed by seam and class value, polygons sharing an edge across the seam
+    are grouped with union-find and dissolved, and all polygons are finally transformed
+    to georeferenced coordinates with the geotransform of the grid. The result covers the
+    same regions as polygonizing the whole raster at once.
+"""
+
+# warped VRT of the raster at the given resolution, with the grid (geotransform, xsize, ysize, projection)
+def warpedGrid(rasterfile,resolution):
+    vrt_ds = gdal.Warp('',rasterfile,format='VRT',xRes=resolution,yRes=resolution,resampleAlg='near')
+    vrt_xml = vrt_ds.GetMetadata('xml:VRT')[0]
+    grid = (vrt_ds.GetGeoTransform(),vrt_ds.RasterXSize,vrt_ds.RasterYSize,vrt_ds.GetProjection())
+    vrt_ds = None
+    return (vrt_xml,grid)
+
+# tiles (x, y, width, height) covering the grid, in row order
+def gridTiles(xsize,ysize,tile_size):
+    return [(x,y,min(tile_size,xsize-x),min(tile_size,ysize-y)) for y in range(0,ysize,tile_size) for x in range(0,xsize,tile_size)]
+
+# seams of the grid touched by a polygon of a tile, as (key, side) pairs; the key identifies
+# the seam segment between two tiles and the class value, side is 0 for the tile above or
+# to the left of the seam and 1 for the other
+def seamKeys(envelope,tile,xsize,ysize,value):
+    (minx, maxx, miny, maxy) = envelope
+    (tx, ty, tw, th) = tile
+    keys = []
+    if tx > 0 and minx <= tx:
+        keys.append((('x',tx,ty,value),1))
+    if tx + tw < xsize and maxx >= tx + tw:
+        keys.append((('x',tx+tw,ty,value),0))
+    if ty > 0 and miny <= ty:
+        keys.append((('y',ty,tx,value),1))
+    if ty + th < ysize and maxy >= ty + th:
+        keys.append((('y',ty+th,tx,value),0))
+    return keys
+
+# polygonize one tile of the warped VRT into (value, wkb, seam keys) records,
+# with coordinates in pixels of the whole grid
+def polygonizeTile(vrt_xml,grid,tile):
+    gdal.UseExceptions()
+    (geotransform, xsize, ysize, projection) = grid
+    (tx, ty, tw, th) = tile
+
+    vrt_ds = gdal.Open(vrt_xml)
+    tile_ds = gdal.Translate('',vrt_ds,format='MEM',srcWin=[tx,ty,tw,th])
+    vrt_ds = None
+    # vertices are integers in this geotransform, so seams line up exactly across tiles
+    tile_ds.SetGeoTransform((float(tx),1.0,0.0,float(ty),0.0,1.0))
+
+    mem_ds = ogr.GetDriverByName('Memory').CreateDataSource('tile')
+    mem_layer = mem_ds.CreateLayer('damfim')
+    mem_layer.CreateField(ogr.FieldDefn('depth',ogr.OFTInteger))
+    band = tile_ds.GetRasterBand(1)
+    gdal.Polygonize(band,band.GetMaskBand(),mem_layer,0,[])
+    tile_ds = None
+
+    records = []
+    for feature in mem_layer:
+        geom = feature.GetGeometryRef()
+        value = feature.GetField('depth')
+        records.append((value,bytes(geom.ExportToWkb()),seamKeys(geom.GetEnvelope(),tile,xsize,ysize,value)))
+    mem_ds = None
+    return records
+
+# transform a geometry in pixel coordinates of the grid to georeferenced coordinates in place
+def pixelToGeo(geom,geotransform):
+    if geom.GetGeometryCount() > 0:
+        for i in range(geom.GetGeometryCount()):
+            pixelToGeo(geom.GetGeometryRef(i),geotransform)
+        return
+    for i in range(geom.GetPointCount()):
+        (x, y) = (geom.GetX(i),geom.GetY(i))
+        geom.SetPoint_2D(i,geotransform[0] + x*geotransform[1] + y*geotransform[2],
+                         geotransform[3] + x*geotransform[4] + y*geotransform[5])
+
+# group the seam polygons that share an edge of non-zero length across a seam
+# returns the lists of polygon indices to be dissolved together
+def seamGroups(geoms,buckets):
+    parent = list(range(len(geoms)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for (key, sides) in buckets.items():
+        # extent of the polygons along the seam
+        if key[0] == 'x':
+            extent = lambda i: geoms[i].GetEnvelope()[2:4]
+        else:
+            extent = lambda i: geoms[i].GetEnvelope()[0:2]
+        others = sorted([(extent(j),j) for j in sides[1]])
+        for i in sides[0]:
+            (start, end) = extent(i)
+            for ((other_start, other_end), j) in others:
+                if other_start >= end:
+                    break
+                if other_end <= start or find(i) == find(j):
+                    continue
+                if geoms[i].Intersection(geoms[j]).Length() > 0:
+                    parent[find(i)] = find(j)
+
+    groups = dict()
+    for i in range(len(geoms)):
+        groups.setdefault(find(i),[]).append(i)
+    return list(groups.values())
+
+# polygonize a raster resampled to the given resolution in tiles of tile_size pixels,
+# writing the dissolved polygons to a GeoJSON layer named damfim with a depth field
+def polygonizeTiled(rasterfile,geojson_out,resolution,tile_size=4096,n_jobs=-1):
+
+    gdal.UseExceptions()
+
+    try:
+        (vrt_xml, grid) = warpedGrid(rasterfile,resolution)
+    except RuntimeError as err:
+        raise GeoEDFError('Error resampling raster %s: %s' % (rasterfile,err))
+    (geotransform, xsize, ysize, projection) = grid
+
+    srs = None
+    if projection:
+        srs = osr.SpatialReference(wkt=projection)
+    out_ds = ogr.GetDriverByName('GeoJSON').CreateDataSource(geojson_out)
+    if out_ds is None:
+        raise GeoEDFError('Error creating GeoJSON output %s' % geojson_out)
+    out_layer = out_ds.CreateLayer('damfim',srs=srs)
+    out_layer.CreateField(ogr.FieldDefn('depth',ogr.OFTInteger))
+
+    def write(geom,value):
+        pixelToGeo(geom,geotransform)
+        feature = ogr.Feature(out_layer.GetLayerDefn())
+        feature.SetField('depth',value)
+        feature.SetGeometry(geom)
+        out_layer.CreateFeature(feature)
+
+    # polygons touching a seam are kept until all tiles are done, the others are final
+    seam_geoms = []
+    seam_values = []
+    buckets = dict()
+
+    tiles = gridTiles(xsize,ysize,tile_size)
+    try:
+        with Parallel(n_jobs=n_jobs) as parallel:
+            if n_jobs > 0:
+                batch_size = 4 * n_jobs
+            else:
+                batch_size = 4 * cpu_count()
+            for i in range(0,len(tiles),batch_size):
+                results = parallel(delayed(polygonizeTile)(vrt_xml,grid,tile) for tile in tiles[i:i+batch_size])
+                for records in results:
+                    for (value, wkb, keys) in records:
+                        geom = ogr.CreateGeometryFromWkb(wkb)
+                        if len(keys) == 0:
+                            write(geom,value)
+                            continue
+                        for (key, side) in keys:
+                            buckets.setdefault(key,([],[]))[side].append(len(seam_geoms))
+                        seam_geoms.append(geom)
+                        seam_values.append(value)
+    except RuntimeError as err:
+        raise GeoEDFError('Error polygonizing tiles of raster %s: %s' % (rasterfile,err))
+
+    # dissolve the polygons connected across seams
+    for group in seamGroups(seam_geoms,buckets):
+        if len(group) == 1:
+            geom = seam_geoms[group[0]]
+        else:
+            parts = ogr.Geometry(ogr.wkbMultiPolygon)
+            for i in group:
+                parts.AddGeometry(seam_geoms[i])
+            geom = parts.UnionCascaded()
+        write(geom,seam_values[group[0]])
+
+    out_ds = None
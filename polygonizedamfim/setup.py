@@ -8,5 +8,5 @@ setup(name='polygonizedamfim',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
-      install_requires=[],
+      install_requires=['joblib'],
       zip_safe=False)
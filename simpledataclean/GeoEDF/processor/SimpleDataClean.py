@@ -1,12 +1,16 @@
 #!/usr/bin/env python3
 
 import os
-import subprocess
-from subprocess import CalledProcessError
+import shutil
+import tempfile
+from joblib import Parallel, delayed
 
 from geoedfframework.GeoEDFPlugin import GeoEDFPlugin
 from geoedfframework.utils.GeoEDFError import GeoEDFError
 
+from .helper.ResultCache import ResultCache
+from .helper.SubprocessRunner import SubprocessRunner
+
 """Module for running the 01_data_clean R script that helps process the 
    FAOSTAT data for preparing the SIMPLE database.
 """
@@ -18,8 +22,12 @@ class SimpleDataClean(GeoEDFPlugin):
     # (2) start year
     # (3) end year
     # optional inputs can override the region, crop, and livestock sets
+    # outputs can be memoized in a cache directory capped at cache_size_mb megabytes
+    # the year range can be split into chunks of year_chunk years that are processed in parallel
+    # the output of the script is streamed to logs in log_dir, along with a run_summary.json of its timings;
+    # without a log_dir, the logs are kept in a temporary directory that is removed after the run
 
-    __optional_params = ['regsets_csv','cropsets_csv','livestocksets_csv']
+    __optional_params = ['regsets_csv','cropsets_csv','livestocksets_csv','cache_dir','cache_size_mb','year_chunk','n_jobs','log_dir']
 
     __required_params = ['fao_input_dir','start_year','end_year']
 
@@ -68,11 +76,49 @@ class SimpleDataClean(GeoEDFPlugin):
         except:
             raise GeoEDFError('Error occurred when validating start_year and end_year for SimpleDataClean; make sure they are integers')
 
+        # years per invocation of the script and number of parallel invocations
+        try:
+            if self.year_chunk is not None:
+                self.year_chunk = int(self.year_chunk)
+                if self.year_chunk < 1:
+                    raise ValueError
+            # every invocation loads the FAOSTAT CSVs into memory, so only two run at a time by default
+            if self.n_jobs is None:
+                self.n_jobs = 2
+            self.n_jobs = int(self.n_jobs)
+            if self.n_jobs < 1:
+                raise ValueError
+        except ValueError:
+            raise GeoEDFError('year_chunk and n_jobs for SimpleDataClean must be positive integers')
+
+        # optional result cache
+        self.cache = None
+        if self.cache_dir is not None:
+            if self.cache_size_mb is None:
+                self.cache_size_mb = 1024
+            self.cache = ResultCache(self.cache_dir,self.cache_size_mb)
+
         # super class init
         super().__init__()
 
     # the process method that calls the 01_data_clean.r script 
+    # logs and timings of the script runs are kept outside of the target path, which only holds the outputs
     def process(self):
+        if self.log_dir is not None:
+            log_dir = self.log_dir
+        else:
+            log_dir = tempfile.mkdtemp(prefix='simpledataclean_logs_')
+        self.runner = SubprocessRunner(log_dir)
+        try:
+            with self.runner.phase('total'):
+                self.clean()
+        finally:
+            if self.log_dir is not None:
+                self.runner.write_summary('%s/run_summary.json' % self.log_dir)
+            else:
+                shutil.rmtree(log_dir,ignore_errors=True)
+
+    def clean(self):
 
         # the R script is invoked with the following command line arguments:
         # 1. start year
@@ -84,21 +130,51 @@ class SimpleDataClean(GeoEDFPlugin):
         # 7. crop sets csv path
         # 8. livestock sets csv path
 
-        # dummy init to catch error in stdout
-        stdout = ''
+        # the script is deterministic; runs are keyed by the contents of all its inputs,
+        # the script itself and the years; on a hit the outputs are restored from the cache
+        if self.cache is not None:
+            inputs = [self.fao_input_dir,self.regmaps_csv,self.regsets_csv,self.cropsets_csv,self.livestocksets_csv,self.data_clean_script]
+            cache_key = self.cache.key(inputs,{'start_year':str(self.start_year),'end_year':str(self.end_year)})
+            if self.cache.restore(cache_key,self.target_path):
+                return
+
+        if self.year_chunk is None:
+            self.run_script(self.start_year,self.end_year,self.target_path)
+        else:
+            # every year is cleaned independently, so chunks of years can be run in parallel
+            # the script runs as a subprocess, so threads suffice to drive the invocations
+            years = list(range(int(self.start_year),int(self.end_year)+1))
+            chunks = [(chunk[0],chunk[-1]) for chunk in [years[i:i+self.year_chunk] for i in range(0,len(years),self.year_chunk)]]
+            Parallel(n_jobs=self.n_jobs,prefer='threads')(delayed(self.run_chunk)(chunk_start,chunk_end) for (chunk_start,chunk_end) in chunks)
+
+        # the outputs are the YYYY_VAR.csv files
+        if self.cache is not None:
+            outputs = [filename for filename in os.listdir(self.target_path) if filename.endswith('.csv')]
+            self.cache.store(cache_key,self.target_path,outputs)
+
+    # run the script for a range of years, writing its outputs to out_dir
+    # its output is streamed to rscript_<start>_<end>.log in the log directory
+    def run_script(self,start_year,end_year,out_dir):
+
+        command = "Rscript"
+        args = [str(start_year),str(end_year),self.fao_input_dir,out_dir,self.regmaps_csv,self.regsets_csv,self.cropsets_csv,self.livestocksets_csv]
+
+        cmd = [command, self.data_clean_script] + args
 
         try:
-            command = "Rscript"
-            args = [str(self.start_year),str(self.end_year),self.fao_input_dir,self.target_path,self.regmaps_csv,self.regsets_csv,self.cropsets_csv,self.livestocksets_csv]
-
-            cmd = [command, self.data_clean_script] + args
-
-            stdout = subprocess.check_output(cmd,universal_newlines=True)
-
-        except CalledProcessError:
-            raise GeoEDFError('Error occurred when running SimpleDataClean processor: %s' % stdout)
-            
-            
-        
-
-    
+            self.runner.run('rscript_%s_%s' % (start_year,end_year),cmd)
+        except GeoEDFError as err:
+            raise GeoEDFError('Error occurred when running SimpleDataClean processor: %s' % err)
+
+    # run the script for a chunk of years in its own output directory (since the script
+    # keeps intermediate files in a temp subdirectory of it), then move the YYYY_VAR.csv
+    # outputs to the target path
+    def run_chunk(self,start_year,end_year):
+        chunk_dir = tempfile.mkdtemp(prefix='.years_%s_%s_' % (start_year,end_year),dir=self.target_path)
+        try:
+            self.run_script(start_year,end_year,chunk_dir)
+            for filename in os.listdir(chunk_dir):
+                if filename.endswith('.csv'):
+                    os.replace('%s/%s' % (chunk_dir,filename),'%s/%s' % (self.target_path,filename))
+        finally:
+            shutil.rmtree(chunk_dir,ignore_errors=True)
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for memoizing the outputs of deterministic processors. Results are
+    stored in a cache directory under a key derived from the contents of the input files,
+    the parameters and the version (contents) of the executable or script that is run.
+    Entries are evicted in least recently used order once the cache exceeds its size cap.
+"""
+
+# name of the file recording the relative paths of the files in a cache entry
+MANIFEST_FILENAME = 'manifest.json'
+
+class ResultCache(object):
+
+    # block size used when hashing files
+    __block_size = 1 << 20
+
+    def __init__(self, cache_dir, max_size_mb=1024):
+        self.cache_dir = cache_dir
+        try:
+            self.max_size = int(float(max_size_mb) * 1024 * 1024)
+        except ValueError:
+            raise GeoEDFError('cache size must be a number of megabytes')
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+        except OSError:
+            raise GeoEDFError('Error creating cache directory %s' % self.cache_dir)
+
+    # update the hash with the contents of a file, or of all files in a directory
+    # (in sorted order, along with their relative paths)
+    def hash_path(self, sha, path):
+        if os.path.isdir(path):
+            for (dirpath, dirnames, filenames) in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    filepath = os.path.join(dirpath, filename)
+                    sha.update(os.path.relpath(filepath, path).encode('utf-8'))
+                    self.hash_path(sha, filepath)
+        elif os.path.isfile(path):
+            with open(path, 'rb') as fileobj:
+                for block in iter(lambda: fileobj.read(self.__block_size), b''):
+                    sha.update(block)
+        else:
+            sha.update(b'<missing>')
+
+    # digest of the contents of a list of files or directories, e.g. of an executable's
+    # directory that is shared by many runs and can be passed to key as a parameter
+    def digest(self, paths):
+        sha = hashlib.sha256()
+        for path in paths:
+            sha.update(b'\0')
+            self.hash_path(sha, path)
+        return sha.hexdigest()
+
+    # cache key for a list of input files or directories and a dict of parameters
+    def key(self, paths, params):
+        sha = hashlib.sha256()
+        sha.update(json.dumps(params, sort_keys=True, default=str).encode('utf-8'))
+        for path in paths:
+            sha.update(b'\0')
+            self.hash_path(sha, path)
+        return sha.hexdigest()
+
+    def entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    # copy the files of a cache entry to the destination directory
+    # returns False on a cache miss
+    def restore(self, key, destination_dir):
+        entry = self.entry_dir(key)
+        manifest_path = os.path.join(entry, MANIFEST_FILENAME)
+        if not os.path.isfile(manifest_path):
+            return False
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                relpaths = json.load(manifest_file)
+            for relpath in relpaths:
+                dst_filepath = os.path.join(destination_dir, relpath)
+                os.makedirs(os.path.dirname(dst_filepath), exist_ok=True)
+                shutil.copy(os.path.join(entry, 'files', relpath), dst_filepath)
+        except (OSError, ValueError):
+            # treat a damaged entry as a miss
+            return False
+        # mark the entry as recently used
+        os.utime(entry, None)
+        return True
+
+    # store files (given relative to base_dir) as a cache entry
+    # entries are assembled in a temporary directory and renamed into place
+    def store(self, key, base_dir, relpaths):
+        entry = self.entry_dir(key)
+        if os.path.isdir(entry):
+            os.utime(entry, None)
+            return
+        staging = tempfile.mkdtemp(prefix='.%s_' % key, dir=self.cache_dir)
+        try:
+            for relpath in relpaths:
+                dst_filepath = os.path.join(staging, 'files', relpath)
+                os.makedirs(os.path.dirname(dst_filepath), exist_ok=True)
+                shutil.copy(os.path.join(base_dir, relpath), dst_filepath)
+            with open(os.path.join(staging, MANIFEST_FILENAME), 'w') as manifest_file:
+                json.dump(list(relpaths), manifest_file)
+            os.rename(staging, entry)
+        except OSError:
+            # another run may have stored the same entry concurrently
+            shutil.rmtree(staging, ignore_errors=True)
+            if not os.path.isdir(entry):
+                raise GeoEDFError('Error storing results in cache directory %s' % self.cache_dir)
+        self.evict()
+
+    def entry_size(self, entry):
+        size = 0
+        for (dirpath, dirnames, filenames) in os.walk(entry):
+            for filename in filenames:
+                size += os.path.getsize(os.path.join(dirpath, filename))
+        return size
+
+    # remove least recently used entries until the cache fits its size cap
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            entry = os.path.join(self.cache_dir, name)
+            if name.startswith('.') or not os.path.isdir(entry):
+                continue
+            entries.append((os.path.getmtime(entry), self.entry_size(entry), entry))
+        total_size = sum([size for (ignore, size, ignore) in entries])
+        for (ignore, size, entry) in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total_size -= size
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+
+from geoedfframework.utils.GeoEDFError import GeoEDFError
+
+""" Helper module for running external programs and timing the phases of a processor.
+    The output of a program is streamed to a log file as it is produced, and its wall
+    time, CPU time and peak resident memory are obtained from wait4. Timings of all
+    phases are collected into a run summary that is written out as JSON.
+"""
+
+# number of trailing log lines included in error messages
+TAIL_LINES = 20
+
+class SubprocessRunner(object):
+
+    def __init__(self, log_dir):
+        self.log_dir = log_dir
+        self.phases = []
+        self.lock = threading.Lock()
+        os.makedirs(self.log_dir, exist_ok=True)
+
+    def record(self, phase):
+        with self.lock:
+            self.phases.append(phase)
+
+    # time a phase of the processor that runs in this process
+    @contextmanager
+    def phase(self, name):
+        start_wall = time.time()
+        start_cpu = time.process_time()
+        try:
+            yield
+        finally:
+            self.record({'phase': name,
+                         'wall_time': time.time() - start_wall,
+                         'cpu_time': time.process_time() - start_cpu})
+
+    # last lines of a log file, for error messages
+    def tail(self, log_path, lines=TAIL_LINES):
+        try:
+            with open(log_path, 'r', errors='replace') as log_file:
+                return ''.join(log_file.readlines()[-lines:])
+        except OSError:
+            return ''
+
+    # run a command, streaming its stdout and stderr to <log_dir>/<name>.log
+    # raises GeoEDFError with the tail of the log if the command fails
+    # returns the phase record with the resource usage of the command
+    def run(self, name, cmd, cwd=None):
+        log_path = os.path.join(self.log_dir, '%s.log' % name)
+        start_wall = time.time()
+        try:
+            with open(log_path, 'wb') as log_file:
+                proc = subprocess.Popen(cmd, cwd=cwd, stdout=log_file, stderr=subprocess.STDOUT)
+                (ignore, status, rusage) = os.wait4(proc.pid, 0)
+        except OSError as err:
+            raise GeoEDFError('Error starting %s: %s' % (' '.join(cmd), err))
+
+        if os.WIFSIGNALED(status):
+            returncode = -os.WTERMSIG(status)
+        else:
+            returncode = os.WEXITSTATUS(status)
+        # the child has already been reaped
+        proc.returncode = returncode
+
+        phase = {'phase': name,
+                 'command': cmd,
+                 'log': log_path,
+                 'returncode': returncode,
+                 'wall_time': time.time() - start_wall,
+                 'user_time': rusage.ru_utime,
+                 'system_time': rusage.ru_stime,
+                 'cpu_time': rusage.ru_utime + rusage.ru_stime,
+                 # kilobytes on Linux
+                 'max_rss_kb': rusage.ru_maxrss}
+        self.record(phase)
+
+        if returncode != 0:
+            raise GeoEDFError('%s exited with code %d:\n%s' % (' '.join(cmd), returncode, self.tail(log_path)))
+        return phase
+
+    # write the run summary as JSON
+    def write_summary(self, summary_path):
+        with self.lock:
+            phases = list(self.phases)
+        with open(summary_path, 'w') as summary_file:
+            json.dump({'phases': phases}, summary_file, indent=2)
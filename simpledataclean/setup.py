@@ -8,6 +8,7 @@ setup(name='simpledataclean',
       author_email='rkalyanapurdue@gmail.com',
       license='MIT',
       packages=find_packages(),
+      install_requires=['joblib'],
       scripts=['bin/01_data_clean.r'],
       data_files=[('data',['data/reg_map.csv','data/reg_sets.csv','data/crop_sets.csv','data/livestock_sets.csv'])],
       include_package_data=True,
@@ -11,9 +11,14 @@ from os import walk
 import subprocess
 import re
 import shutil
+import tempfile
+from joblib import Parallel, delayed
 
 from pathlib import Path
 
+from .helper.ResultCache import ResultCache
+from .helper.SubprocessRunner import SubprocessRunner
+
 class SimplegTool(GeoEDFPlugin):
     """ Module for running 02_data_proc binary file that generates
         two database files ( LANDDATA.har, DATACHKS.har).
@@ -52,10 +57,39 @@ class SimplegTool(GeoEDFPlugin):
                 to the destination directory.se_year/variable.har.
         Please refer to move_har_to_YYYY() for details.
 
+        By default (staging = copy) the whole /simpleg directory is copied into the
+        output directory before running the model. With staging = link, only the
+        directory structure is recreated; the binary and static inputs are symlinked,
+        the command file is copied and an empty out directory is created. HAR files
+        are then hard linked into YYYY/ instead of copied. Since the symlinks would
+        dangle outside of this container, the linked workspace is a temporary directory
+        that is removed once its HAR files are moved to target_path. Optionally, the model can
+        be run in a scratch_dir (e.g. a tmpfs like /dev/shm); the resulting HAR files
+        are moved to target_path and the scratch workspace is removed afterwards.
+
+        target_year can also be a list of years, a comma separated list or a range
+        such as 2001-2010. Every year is then run in its own workspace, with up to
+        max_workers years running concurrently, and the HAR files of each year are
+        collected in target_path/YYYY.
+
+        Since the model is deterministic, its outputs can be memoized in a cache_dir.
+        Runs are keyed by the year, the contents of its input HAR files and of /simpleg;
+        on a hit the HAR files are restored from the cache instead of running the model.
+        The cache is capped at cache_size_mb megabytes, evicting least recently used runs.
+
+        The output of the model is streamed to a log per run. If a log_dir is provided,
+        the logs are kept there along with a run_summary.json holding the wall time, CPU
+        time and peak memory of every run and the timings of the staging and collection
+        phases; otherwise they are only used for error messages and then removed, so that
+        nothing but the HAR files ends up in target_path.
+
     """
-    __optional_params = []
+    __optional_params = ['staging', 'scratch_dir', 'max_workers', 'cache_dir', 'cache_size_mb', 'log_dir']
     __required_params = ['har_input_dir', 'target_year']
 
+    # files in /simpleg that are written by the model and hence copied when staging with links
+    __writable_extensions = ('.cmf', '.log')
+
     # we use just kwargs since we need to be able to process the list of attributes
     # and their values to create the dependency graph in the GeoEDFPlugin super class
     def __init__(self, **kwargs):
@@ -79,6 +113,30 @@ class SimplegTool(GeoEDFPlugin):
             # if key not provided in optional arguments, defaults value to None
             setattr(self,key,kwargs.get(key,None))
 
+        # staging mode for the /simpleg working directory
+        if self.staging is None:
+            self.staging = 'copy'
+        if self.staging not in ['copy', 'link']:
+            raise GeoEDFError('staging for SimplegTool must be either copy or link')
+
+        # list of years to run the model for
+        self.target_years = self.parse_years(self.target_year)
+
+        # number of years run concurrently
+        try:
+            if self.max_workers is None:
+                self.max_workers = min(len(self.target_years), os.cpu_count() or 1)
+            self.max_workers = int(self.max_workers)
+        except ValueError:
+            raise GeoEDFError('max_workers for SimplegTool must be an integer')
+
+        # optional result cache
+        self.cache = None
+        if self.cache_dir is not None:
+            if self.cache_size_mb is None:
+                self.cache_size_mb = 1024
+            self.cache = ResultCache(self.cache_dir, self.cache_size_mb)
+
         # class super class init
         super().__init__()
 
@@ -87,18 +145,117 @@ class SimplegTool(GeoEDFPlugin):
     # assume this method is called only when all params have been fully instantiated
     def process(self):
 
+        # logs and timings of all phases are kept outside of the output directory;
+        # without a log_dir they are written to a temporary directory that is removed afterwards
+        if self.log_dir is not None:
+            log_dir = self.log_dir
+        else:
+            log_dir = tempfile.mkdtemp(prefix='simpleg_logs_')
+        self.runner = SubprocessRunner(log_dir)
+        try:
+            with self.runner.phase("total"):
+                # /simpleg is the same for every year, so it is hashed only once for the cache keys
+                if self.cache is not None:
+                    with self.runner.phase("hash_simpleg"):
+                        self.simpleg_digest = self.cache.digest(["/simpleg"])
+                self.run_years()
+        finally:
+            if self.log_dir is not None:
+                self.runner.write_summary(os.path.join(self.log_dir, "run_summary.json"))
+            else:
+                shutil.rmtree(log_dir, ignore_errors=True)
+
+    def run_years(self):
+        """ Restructure the input HAR files and run the model for every target year.
+        """
+
         # restructure CSV2HAR output directory structure
-        self.move_har_to_YYYY()
+        with self.runner.phase("move_har_to_YYYY"):
+            self.move_har_to_YYYY()
         
         #Singualarity container cannot modify its file system.
         #The binary modifies the same directory where it sits in.
         #Therefore /simpleg directory is copied to the writable output directory
         #of the SimplegTool processor, and the final HAR files are copied to the topmost
         #directory of the SimplegTool output directory.
-        self.copy_simpleg_to_target_path()
+        #The workspace can instead be created in a scratch directory.
+        if len(self.target_years) == 1:
+            self.run_year(self.target_years[0], self.target_path)
+        else:
+            # the model runs as a subprocess, so threads suffice to drive the runs
+            Parallel(n_jobs=self.max_workers, prefer='threads')(delayed(self.run_year)(year, os.path.join(self.target_path, str(year))) for year in self.target_years)
+
+    def parse_years(self, target_year):
+        """ Parse target_year into a list of years.
+
+            Accepts a single year, a list of years, a comma separated list
+            of years or a range of years such as 2001-2010 (inclusive).
+        """
+        if isinstance(target_year, list):
+            items = target_year
+        else:
+            items = str(target_year).split(',')
+        years = []
+        try:
+            for item in items:
+                item = str(item).strip()
+                if item == '':
+                    continue
+                if '-' in item:
+                    (start, end) = item.split('-')
+                    years.extend(range(int(start), int(end)+1))
+                else:
+                    years.append(int(item))
+        except ValueError:
+            raise GeoEDFError('Invalid target_year %s for SimplegTool' % target_year)
+        if len(years) == 0:
+            raise GeoEDFError('At least one target_year needs to be provided to SimplegTool')
+        return sorted(set(years))
+
+    def run_year(self, year, destination_dir):
+        """ Run the model for a year in its own workspace, collecting the HAR files
+            in destination_dir.
+        """
+        Path(destination_dir).mkdir(parents=True, exist_ok=True)
+
+        # restore the outputs of an identical earlier run if cached
+        if self.cache is not None:
+            cache_key = self.cache.key([os.path.join(self.har_input_dir, str(year))], {'year': year, 'simpleg': self.simpleg_digest})
+            if self.cache.restore(cache_key, destination_dir):
+                print("restored cached outputs for year %s" % year)
+                return
+
+        # a linked workspace holds symlinks into /simpleg that would dangle outside of this
+        # container, so it is never left in the output; without a scratch_dir it is created
+        # as a hidden directory next to the outputs, so that the HAR files can be moved cheaply
+        temporary_workspace = self.scratch_dir is not None or self.staging == 'link'
+        if self.scratch_dir is not None:
+            workspace = tempfile.mkdtemp(prefix='simpleg_%s_' % year, dir=self.scratch_dir)
+        elif self.staging == 'link':
+            workspace = tempfile.mkdtemp(prefix='.simpleg_%s_' % year, dir=destination_dir)
+        else:
+            workspace = destination_dir
+
+        try:
+            har_files = self.run_model(workspace, year, destination_dir)
+            if self.cache is not None:
+                self.cache.store(cache_key, destination_dir, har_files)
+        finally:
+            if temporary_workspace:
+                shutil.rmtree(workspace, ignore_errors=True)
+
+    def run_model(self, workspace, year, destination_dir):
+        """ Stage /simpleg in the workspace, run the model for the given year and 
+            collect its HAR files in destination_dir. Returns the names of these files.
+        """
+        with self.runner.phase("stage_%s" % year):
+            if self.staging == 'link':
+                self.link_simpleg_to_workspace(workspace)
+            else:
+                self.copy_simpleg_to_target_path(workspace)
         
         # the directory simpleg binary is located at
-        exec_dir = self.target_path+"/simpleg/02_data_proc"
+        exec_dir = workspace+"/simpleg/02_data_proc"
         # the executable path 
         exec_path = exec_dir +"/02_data_proc"
         # the command file path 
@@ -107,11 +264,12 @@ class SimplegTool(GeoEDFPlugin):
         output_har_dir = exec_dir+"/out"
         
         #make command file to look up given base year's input data
-        self.edit_CMF_target_path(cmf_path)
-        
+        self.edit_CMF_target_path(cmf_path, year)
         
+        # output of the model is streamed to its log; a failed run raises an error
+        self.runner.run("02_data_proc_%s" % year, [exec_path, "-cmf", cmf_path], cwd= exec_dir)
+
         try:
-            subprocess.call([exec_path, "-cmf", cmf_path], cwd= exec_dir)
             # Not working 
             # wildcard character is literally interpreted and cause no such file error
             #subprocess.check_output(["/bin/cp", output_har_dir+"/*.har", self.target_path])
@@ -122,13 +280,20 @@ class SimplegTool(GeoEDFPlugin):
             # want to copy all har files model binary produced
             har_files_to_copy = output_har_dir+"/*.har"
             
-            self.copy_hars_to_destination(har_files_to_copy, self.target_path)
+            # outputs of a workspace that is not kept around can simply be moved
+            with self.runner.phase("collect_%s" % year):
+                if workspace != destination_dir:
+                    har_files = self.move_hars_to_destination(har_files_to_copy, destination_dir)
+                else:
+                    har_files = self.copy_hars_to_destination(har_files_to_copy, destination_dir)
             
             
             #subprocess.call(["/bin/rm","-rf", self.target_path+"/simpleg/"])
 
         except:
-            raise GeoEDFError('Error occurred when running SimplegTool processor')
+            raise GeoEDFError('Error occurred when collecting the outputs of SimplegTool processor for year %s' % year)
+
+        return har_files
 
             
 
@@ -139,16 +304,35 @@ class SimplegTool(GeoEDFPlugin):
             Turns out that copying files using subprocess with wildcard causes 
             either failure or shell execution concern.
             This function copies all har files in subdirectory of the target path 
-            to the destination directory.
+            to the destination directory. Returns the names of the copied files.
         """
+        filenames = []
         for file in glob.glob(pattern):
             print(file)
             shutil.copy(file, destination_dir)
+            filenames.append(os.path.basename(file))
+        return filenames
             
+    def move_hars_to_destination(self, pattern, destination_dir):
+        """ Move har files matching the given pattern to the destination directory
+
+            Used when the model ran in a staged or scratch workspace, where the
+            produced files need not be kept; this is a rename on the same filesystem.
+            Returns the names of the moved files.
+        """
+        filenames = []
+        for file in glob.glob(pattern):
+            print(file)
+            dst_filepath = os.path.join(destination_dir, os.path.basename(file))
+            if os.path.exists(dst_filepath):
+                os.remove(dst_filepath)
+            shutil.move(file, dst_filepath)
+            filenames.append(os.path.basename(file))
+        return filenames
         
         
 
-    def copy_simpleg_to_target_path(self):
+    def copy_simpleg_to_target_path(self, workspace=None):
         """ Copy /simpleg directory of the Singularity container to output directory.
     
             This is to circumvent the read-only limitation of the Singularity container.
@@ -156,12 +340,54 @@ class SimplegTool(GeoEDFPlugin):
             a temporary execution place, output directory of the SimplegTool processor,
             and then executable is invoked.
         """
+        if workspace is None:
+            workspace = self.target_path
         try:
-            subprocess.call(["/bin/cp","-r", "/simpleg", self.target_path])
+            subprocess.call(["/bin/cp","-r", "/simpleg", workspace])
 
         except:
             raise GeoEDFError('Error occurred when copying simpleg to the SimplegTool output directory')
 
+    def link_simpleg_to_workspace(self, workspace):
+        """ Stage /simpleg in the workspace using symbolic links.
+
+            The directory tree is recreated, and the read-only binary and static
+            inputs are symlinked. Only the files the model writes (the command file
+            and logs) are copied, and out directories are created empty, so that
+            a run starts with a few KB of I/O instead of a copy of the full tree.
+        """
+        try:
+            for (dirpath, dirnames, filenames) in walk("/simpleg"):
+                dst_dir = os.path.join(workspace, "simpleg", os.path.relpath(dirpath, "/simpleg"))
+                Path(dst_dir).mkdir(parents=True, exist_ok=True)
+                # outputs are written afresh by the model
+                if os.path.basename(dirpath) == "out":
+                    dirnames[:] = []
+                    continue
+                for filename in filenames:
+                    src_filepath = os.path.join(dirpath, filename)
+                    dst_filepath = os.path.join(dst_dir, filename)
+                    if os.path.lexists(dst_filepath):
+                        os.remove(dst_filepath)
+                    if filename.endswith(self.__writable_extensions):
+                        shutil.copy(src_filepath, dst_filepath)
+                    else:
+                        os.symlink(src_filepath, dst_filepath)
+            Path(os.path.join(workspace, "simpleg", "02_data_proc", "out")).mkdir(parents=True, exist_ok=True)
+
+        except:
+            raise GeoEDFError('Error occurred when staging simpleg in the SimplegTool workspace')
+
+    def link_or_copy(self, src_filepath, dst_filepath):
+        """ Hard link a file, falling back to a copy across filesystems.
+        """
+        if os.path.lexists(dst_filepath):
+            os.remove(dst_filepath)
+        try:
+            os.link(src_filepath, dst_filepath)
+        except OSError:
+            shutil.copy(src_filepath, dst_filepath)
+
             
             
 
@@ -194,18 +420,23 @@ class SimplegTool(GeoEDFPlugin):
                 Path( os.path.join(dirpath,m.group('year'))).mkdir(parents=True, exist_ok=True)
                 src_filepath = os.path.join(dirpath, filename)
                 dst_filepath = os.path.join(dirpath, m.group('year'), m.group('varname')+".har")
-                shutil.copy( src_filepath , dst_filepath)
+                if self.staging == 'link':
+                    self.link_or_copy(src_filepath, dst_filepath)
+                else:
+                    shutil.copy( src_filepath , dst_filepath)
         
 
-    def edit_CMF_target_path(self, cmf_path):
+    def edit_CMF_target_path(self, cmf_path, year=None):
         """ find predefined variable <YYYY_PATH> in command file, 
-            and replace it with target_year's directory.
+            and replace it with target_year's directory (or the given year's).
 
             ex, FILE INC_DAT   = <YYYY_PATH>/INC.har;
                 may be replaced with 
                 FILE INC_DAT   = /data/37393048/3/2005/INC.har"
         """
-        target_year_path = os.path.join(self.har_input_dir,str(self.target_year)) 
+        if year is None:
+            year = self.target_year
+        target_year_path = os.path.join(self.har_input_dir,str(year)) 
         self.replace_string_in_file(cmf_path, "<YYYY_PATH>", target_year_path)
     
     
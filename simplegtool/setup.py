@@ -8,5 +8,5 @@ setup(name='simplegtool',
       author_email='jungha.woo@gmail.com',
       license='MIT',
       packages=find_packages(),
-      install_requires=['geopandas'],
+      install_requires=['geopandas','joblib'],
       zip_safe=False)